@@ -54,6 +54,11 @@ kubectl apply -f qdrant-collection-init.yaml -n "${NS}"
 kubectl wait --for=condition=complete job/qdrant-collection-init -n "${NS}" --timeout=120s 2>/dev/null || sleep 15
 
 echo "[5/7] RAG Backend (CoinTutor + DrillQuiz) / Frontend"
+# Scripts ConfigMap first: the backends mount embedding_providers.py from it
+if [[ -f "${SCRIPT_DIR}/scripts/ingest.py" ]]; then
+  kubectl create configmap rag-ingestion-script --from-file="${SCRIPT_DIR}/scripts/ingest.py" \
+    --from-file="${SCRIPT_DIR}/scripts/embedding_providers.py" -n "${NS}" --dry-run=client -o yaml | kubectl apply -f -
+fi
 kubectl apply -f cointutor/rag-backend.yaml -n "${NS}"
 kubectl apply -f drillquiz/rag-backend-drillquiz.yaml -n "${NS}"
 kubectl apply -f rag-frontend.yaml -n "${NS}"
@@ -68,10 +73,7 @@ echo "[6/7] Ingress (rag, rag-ui)"
 sed -e "s/k8s_project/${k8s_project}/g" -e "s/k8s_domain/${k8s_domain}/g" rag-ingress.yaml > rag-ingress.yaml_bak
 kubectl apply -f rag-ingress.yaml_bak -n "${NS}"
 
-echo "[7/7] Ingestion (ConfigMap + CronJob: cointutor, drillquiz)"
-if [[ -f "${SCRIPT_DIR}/scripts/ingest.py" ]]; then
-  kubectl create configmap rag-ingestion-script --from-file="${SCRIPT_DIR}/scripts/ingest.py" -n "${NS}" --dry-run=client -o yaml | kubectl apply -f -
-fi
+echo "[7/7] Ingestion (CronJob: cointutor, drillquiz)"
 kubectl apply -f cointutor/rag-ingestion-cronjob-cointutor.yaml -n "${NS}"
 kubectl apply -f drillquiz/rag-ingestion-cronjob-drillquiz.yaml -n "${NS}"
 
@@ -19,20 +19,47 @@ REINDEX="${2:-}"
 
 POD_NAME="rag-qdrant-reset-$$"
 
+# Collection create body; storage settings come from the same env as ingest.py
+# (QDRANT_QUANTIZATION=none|scalar|binary, QDRANT_ON_DISK, QDRANT_ON_DISK_PAYLOAD, HNSW_M, HNSW_EF_CONSTRUCT)
+collection_body() {
+  local quant=""
+  case "${QDRANT_QUANTIZATION:-none}" in
+    scalar) quant=',"quantization_config":{"scalar":{"type":"int8","quantile":0.99,"always_ram":true}}' ;;
+    binary) quant=',"quantization_config":{"binary":{"always_ram":true}}' ;;
+  esac
+  echo '{"vectors":{"size":1536,"distance":"Cosine","on_disk":'"${QDRANT_ON_DISK:-false}"'},"sparse_vectors":{"text":{"modifier":"idf"}},"on_disk_payload":'"${QDRANT_ON_DISK_PAYLOAD:-false}"',"hnsw_config":{"m":'"${HNSW_M:-16}"',"ef_construct":'"${HNSW_EF_CONSTRUCT:-100}"'}'"${quant}"'}'
+}
+
+# Shell snippet (run in the curl Pod) that empties collection $1: delete every version <name>_v<ts>
+# and a legacy plain collection <name>, then point alias <name> at a fresh empty version
+reset_cmd() {
+  local c="$1"
+  cat <<EOF
+for v in \$(curl -s http://qdrant:6333/collections | grep -o '"${c}_v[0-9]*"' | tr -d '"'); do curl -s -X DELETE http://qdrant:6333/collections/\$v; done
+curl -s -X DELETE http://qdrant:6333/collections/${c} || true
+v=${c}_v\$(date -u +%Y%m%d%H%M%S)
+curl -s -X PUT http://qdrant:6333/collections/\$v -H 'Content-Type: application/json' -d '$(collection_body)'
+curl -s -X POST http://qdrant:6333/collections/aliases -H 'Content-Type: application/json' -d '{"actions":[{"create_alias":{"collection_name":"'\$v'","alias_name":"${c}"}}]}'
+echo ${c} ok
+EOF
+}
+
 # Run curl from a Pod that can reach Qdrant (inside cluster)
 run_reset() {
   local topic="$1"
   local cmd
   case "$topic" in
     cointutor)
-      cmd='curl -s -X DELETE http://qdrant:6333/collections/rag_docs_cointutor || true; curl -s -X PUT http://qdrant:6333/collections/rag_docs_cointutor -H "Content-Type: application/json" -d "{\"vectors\":{\"size\":1536,\"distance\":\"Cosine\"}}"; echo cointutor ok'
+      cmd="$(reset_cmd rag_docs_cointutor)"
       ;;
     drillquiz)
-      cmd='curl -s -X DELETE http://qdrant:6333/collections/rag_docs_drillquiz || true; curl -s -X PUT http://qdrant:6333/collections/rag_docs_drillquiz -H "Content-Type: application/json" -d "{\"vectors\":{\"size\":1536,\"distance\":\"Cosine\"}}"; echo drillquiz ok'
+      cmd="$(reset_cmd rag_docs_drillquiz)"
       ;;
     all|*)
       # Delete legacy rag_docs (do not recreate). Recreate cointutor/drillquiz only
-      cmd='curl -s -X DELETE http://qdrant:6333/collections/rag_docs || true; curl -s -X DELETE http://qdrant:6333/collections/rag_docs_cointutor || true; curl -s -X PUT http://qdrant:6333/collections/rag_docs_cointutor -H "Content-Type: application/json" -d "{\"vectors\":{\"size\":1536,\"distance\":\"Cosine\"}}"; curl -s -X DELETE http://qdrant:6333/collections/rag_docs_drillquiz || true; curl -s -X PUT http://qdrant:6333/collections/rag_docs_drillquiz -H "Content-Type: application/json" -d "{\"vectors\":{\"size\":1536,\"distance\":\"Cosine\"}}"; echo all ok'
+      cmd="curl -s -X DELETE http://qdrant:6333/collections/rag_docs || true
+$(reset_cmd rag_docs_cointutor)
+$(reset_cmd rag_docs_drillquiz)"
       ;;
   esac
 
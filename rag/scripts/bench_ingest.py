@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Offline ingest benchmark: synthetic corpus -> ingest.py main() -> report.
+No MinIO, Qdrant server or embedding API needed: the corpus is written to a temp dir and read via
+SOURCE_DIR, vectors come from EMBEDDING_PROVIDER=fake, points go to in-process Qdrant (:memory:).
+
+Usage: python bench_ingest.py [--docs 200] [--kb 20] [--mix pdf=1,md=2,txt=1] [--embed-latency-ms 150]
+                              [--dup-ratio 0.1] [--json report.json] [--keep DIR]
+Any ingest.py env (FETCH_WORKERS, EXTRACT_WORKERS, EMBED_BATCH_SIZE, CHUNK_UNIT, DEDUP, ...) passes through.
+Set QDRANT_HOST (and unset QDRANT_LOCATION) to benchmark against a real Qdrant instead.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import ingest  # noqa: E402
+
+BUCKET = "rag-docs"
+PREFIX = "raw/bench/"
+WORDS = (
+    "qdrant vector index chunk embedding minio bucket object cluster node pod replica quiz answer "
+    "question token latency throughput batch retry backoff payload filter alias collection "
+    "쿠버네티스 파드 노드 질문 답변 문서 검색 벡터 임베딩 배치"
+).split()
+
+
+def sentence(rnd: random.Random) -> str:
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(6, 18))]
+    return " ".join(words).capitalize() + rnd.choice([".", ".", ".", "?", "!"])
+
+
+def paragraph(rnd: random.Random) -> str:
+    return " ".join(sentence(rnd) for _ in range(rnd.randint(2, 6)))
+
+
+def body(rnd: random.Random, kb: float, markdown: bool) -> str:
+    parts, size, section = [], 0, 0
+    while size < kb * 1024:
+        if markdown and rnd.random() < 0.2:
+            section += 1
+            parts.append(f"{'#' * rnd.randint(1, 3)} Section {section}")
+        parts.append(paragraph(rnd))
+        size += len(parts[-1].encode())
+    return "\n\n".join(parts)
+
+
+def pdf_bytes(text: str, lines_per_page: int = 45) -> bytes:
+    """Minimal text PDF (Helvetica, one Tj per line). Non-Latin-1 words are dropped: PDF base fonts are Latin-1."""
+    lines = []
+    for para in text.split("\n\n"):
+        words, line = [w for w in para.split() if w.isascii()], ""
+        for w in words:
+            if len(line) + len(w) > 90:
+                lines.append(line)
+                line = ""
+            line += w + " "
+        lines.append(line)
+    pages = [lines[i : i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[""]]
+    objs = {1: "<< /Type /Catalog /Pages 2 0 R >>"}
+    font = 3 + 2 * len(pages)
+    kids = []
+    for n, page in enumerate(pages):
+        pid, cid = 3 + 2 * n, 4 + 2 * n
+        kids.append(f"{pid} 0 R")
+        esc = [l.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for l in page]
+        stream = "BT /F1 10 Tf 40 800 Td 12 TL " + " ".join(f"({l}) Tj T*" for l in esc) + " ET"
+        objs[pid] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {cid} 0 R "
+                     f"/Resources << /Font << /F1 {font} 0 R >> >> >>")
+        objs[cid] = f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream"
+    objs[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>"
+    objs[font] = "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    out, offsets = bytearray(b"%PDF-1.4\n"), {}
+    for num in sorted(objs):
+        offsets[num] = len(out)
+        out += f"{num} 0 obj\n{objs[num]}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {font + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offsets[i]:010d} 00000 n \n" for i in range(1, font + 1)).encode()
+    out += f"trailer << /Size {font + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def generate_corpus(root: Path, docs: int, kb: float, mix: dict, dup_ratio: float, seed: int) -> int:
+    """Write docs files under root/BUCKET/PREFIX; dup_ratio of them are lightly edited copies. Returns bytes."""
+    rnd = random.Random(seed)
+    base = root / BUCKET / PREFIX
+    base.mkdir(parents=True, exist_ok=True)
+    kinds = [k for k, w in mix.items() for _ in range(w)]
+    texts, total = [], 0
+    for i in range(docs):
+        kind = rnd.choice(kinds)
+        if texts and rnd.random() < dup_ratio:
+            text = rnd.choice(texts) + "\n\n" + paragraph(rnd)
+        else:
+            text = body(rnd, kb, markdown=(kind == "md"))
+            texts.append(text)
+        data = pdf_bytes(text) if kind == "pdf" else text.encode()
+        (base / f"doc{i:05d}.{kind}").write_bytes(data)
+        total += len(data)
+    return total
+
+
+def parse_mix(v: str) -> dict:
+    mix = {}
+    for part in v.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("pdf", "md", "txt"):
+            raise argparse.ArgumentTypeError(f"unknown kind {kind!r} (pdf, md, txt)")
+        mix[kind] = int(weight or 1)
+    return mix
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline ingest.py benchmark (synthetic corpus, fake embedder, in-memory Qdrant)")
+    ap.add_argument("--docs", type=int, default=200, help="number of documents (default 200)")
+    ap.add_argument("--kb", type=float, default=20, help="approx. text size per document in KB (default 20)")
+    ap.add_argument("--mix", type=parse_mix, default=parse_mix("pdf=1,md=2,txt=1"), help="kind weights (default pdf=1,md=2,txt=1)")
+    ap.add_argument("--dup-ratio", type=float, default=0.0, help="share of documents that are edited copies (default 0)")
+    ap.add_argument("--embed-latency-ms", type=float, default=0.0, help="simulated latency per embedding request")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="also write the report as JSON to this file")
+    ap.add_argument("--keep", help="generate the corpus into this dir and keep it (default: temp dir, removed)")
+    args = ap.parse_args()
+
+    root = Path(args.keep) if args.keep else Path(tempfile.mkdtemp(prefix="ingest-bench-"))
+    try:
+        t0 = time.perf_counter()
+        corpus_bytes = generate_corpus(root, args.docs, args.kb, args.mix, args.dup_ratio, args.seed)
+        print(f"Corpus: {args.docs} docs, {corpus_bytes / 1e6:.1f} MB in {root} ({time.perf_counter() - t0:.1f}s)")
+
+        os.environ.update({
+            "SOURCE_DIR": str(root),
+            "MINIO_BUCKET": BUCKET,
+            "MINIO_PREFIX": PREFIX,
+            "EMBEDDING_PROVIDER": "fake",
+            "EMBED_FAKE_LATENCY_MS": str(args.embed_latency_ms),
+            "INGEST_MODE": "full",
+            "QDRANT_COLLECTION": "rag_docs_bench",
+        })
+        os.environ.setdefault("EMBED_CACHE", "false")
+        os.environ.setdefault("EMBED_CACHE_PATH", str(root / "embed-cache.sqlite"))
+        if not os.environ.get("QDRANT_HOST"):
+            os.environ.setdefault("QDRANT_LOCATION", ":memory:")
+
+        t0 = time.perf_counter()
+        ingest.main()
+        wall = time.perf_counter() - t0
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    stats = ingest.STATS
+    docs = stats.items.get("chunk", 0)
+    report = {
+        "docs": docs,
+        "chunks": stats.counters.get("chunks", 0),
+        "points": stats.counters.get("points", 0),
+        "corpus_mb": round(corpus_bytes / 1e6, 2),
+        "wall_s": round(wall, 3),
+        "docs_per_s": round(docs / wall, 2) if wall else 0,
+        "chunks_per_s": round(stats.counters.get("chunks", 0) / wall, 2) if wall else 0,
+        "peak_rss_mb": round(ingest.peak_rss_mb(), 1),
+        # Busy time summed over workers; can exceed wall time when a stage runs in parallel
+        "stages": {k: {"busy_s": round(v, 3), "items": stats.items[k]} for k, v in stats.seconds.items()},
+        "env": {k: os.environ[k] for k in sorted(os.environ) if k.startswith(("FETCH_", "EXTRACT_", "EMBED_", "CHUNK_", "UPSERT_", "PIPELINE_", "DEDUP"))},
+    }
+    print()
+    print(f"docs/s {report['docs_per_s']}  chunks/s {report['chunks_per_s']}  wall {report['wall_s']}s  peak RSS {report['peak_rss_mb']} MB")
+    print(f"{'stage':<10}{'busy s':>10}{'items':>10}{'ms/item':>10}")
+    for name, st in report["stages"].items():
+        per = 1000 * st["busy_s"] / st["items"] if st["items"] else 0
+        print(f"{name:<10}{st['busy_s']:>10.2f}{st['items']:>10}{per:>10.2f}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""
+Embedding providers shared by ingest.py and the RAG backends (rag-backend*.yaml mount this file
+from ConfigMap rag-ingestion-script).
+
+Each provider keeps one SDK client for the life of the process, so batches and queries reuse its
+HTTP connection pool instead of paying TLS setup per call. SDKs are imported on first use: a Pod
+only needs the package of the provider it runs.
+env: EMBEDDING_PROVIDER=openai|gemini|fake, EMBEDDING_MODEL,
+     OpenAI: OPENAI_API_KEY (text-embedding-3-small, 1536 dims)
+     Gemini: GEMINI_API_KEY (or GOOGLE_API_KEY), EMBEDDING_DIM (default 1536)
+     fake: deterministic vectors from the text hash, no API (tests/benchmarks); EMBEDDING_DIM, EMBED_FAKE_LATENCY_MS
+
+Contract: embed_documents(texts) / embed_query(text) make one API call and do not retry; callers wrap
+them in call_with_retry. batch_size / batch_tokens are the largest request ingest packs for the provider.
+aembed_query(text) is the asyncio variant (backends) on a second, async SDK client; wrap it in
+async_call_with_retry and close it with aclose() on shutdown.
+
+QueryCache (backends): query vectors by (provider, model, dim, normalised question), LRU + TTL in process,
+optionally shared through Redis (QUERY_CACHE_REDIS_URL; needs the redis package).
+MicroBatcher (backends): concurrent requests' query texts sent as one embedding request.
+"""
+import os
+import sys
+import time
+import asyncio
+import inspect
+import random
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# Errors without an HTTP status that are worth retrying, matched by class name so no SDK is imported:
+# builtin/requests ConnectionError and timeouts, httpx.TransportError (incl. timeouts),
+# openai.APIConnectionError / APITimeoutError
+TRANSIENT_ERRORS = {"ConnectionError", "TimeoutError", "Timeout", "TransportError", "APIConnectionError", "APITimeoutError"}
+
+def get_env(name: str, default: str = "") -> str:
+    return os.environ.get(name, default).strip()
+
+def error_status(e: Exception) -> int | None:
+    """HTTP status of an SDK error (openai: status_code, google-genai: code), if any."""
+    for attr in ("status_code", "code", "status"):
+        v = getattr(e, attr, None)
+        if isinstance(v, int):
+            return v
+    v = getattr(getattr(e, "response", None), "status_code", None)
+    return v if isinstance(v, int) else None
+
+def parse_duration(v: str) -> float | None:
+    """Seconds from '12', '1.5', '20ms', '6m0s' (OpenAI x-ratelimit-reset-* format)."""
+    v = (v or "").strip()
+    if not v:
+        return None
+    try:
+        return float(v)
+    except ValueError:
+        pass
+    total, num = 0.0, ""
+    i = 0
+    while i < len(v):
+        ch = v[i]
+        if ch.isdigit() or ch == ".":
+            num += ch
+        elif v.startswith("ms", i) and num:
+            total += float(num) / 1000
+            num = ""
+            i += 1
+        elif ch in "hms" and num:
+            total += float(num) * {"h": 3600, "m": 60, "s": 1}[ch]
+            num = ""
+        else:
+            return None
+        i += 1
+    return total if not num else None
+
+def is_transient(e: Exception) -> bool:
+    """Connection or timeout error (no HTTP response)."""
+    return any(c.__name__ in TRANSIENT_ERRORS for c in type(e).__mro__)
+
+def is_retryable(e: Exception) -> bool:
+    """Rate-limit, server or connection error: worth retrying, and not caused by any one input."""
+    status = error_status(e)
+    return status in RETRYABLE_STATUS if status is not None else is_transient(e)
+
+def retry_after(e: Exception) -> float | None:
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        ms = parse_duration(headers["retry-after-ms"])
+        if ms is not None:
+            return ms / 1000
+    waits = [parse_duration(headers.get(h, "")) for h in ("retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+    waits = [w for w in waits if w is not None]
+    return max(waits) if waits else None
+
+def retry_delay(e: Exception, attempt: int, retries: int, label: str, base_delay: float, max_delay: float,
+                on_retry=None) -> float | None:
+    """Seconds to wait before retrying after e (Retry-After or backoff + jitter); None = give up."""
+    status = error_status(e)
+    if attempt >= retries or not is_retryable(e):
+        return None
+    delay = retry_after(e)
+    if delay is None:
+        delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+    if on_retry:
+        on_retry(status)
+    print(f"Embedding retry {attempt + 1}/{retries} ({label}, status={status}) in {delay:.1f}s: {e}", file=sys.stderr)
+    return min(delay, max_delay)
+
+def call_with_retry(fn, arg, retries: int, label: str, base_delay: float = 1.0, max_delay: float = 60.0, on_retry=None):
+    """Call fn(arg); retry rate-limit, server and connection errors with exponential backoff + jitter.
+
+    on_retry(status) is called before each retry (metrics).
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn(arg)
+        except Exception as e:
+            delay = retry_delay(e, attempt, retries, label, base_delay, max_delay, on_retry)
+            if delay is None:
+                raise
+            time.sleep(delay)
+
+async def async_call_with_retry(fn, arg, retries: int, label: str, base_delay: float = 1.0, max_delay: float = 60.0,
+                                on_retry=None):
+    """call_with_retry for a coroutine function; waits without blocking the event loop."""
+    for attempt in range(retries + 1):
+        try:
+            return await fn(arg)
+        except Exception as e:
+            delay = retry_delay(e, attempt, retries, label, base_delay, max_delay, on_retry)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+
+class EmbeddingProvider:
+    """One embedding model behind a lazily created, shared SDK client."""
+
+    name = ""
+    batch_size, batch_tokens = 512, 200_000
+
+    def __init__(self, model: str, dim: int):
+        self.model, self.dim = model, dim
+        self._client = self._aclient = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        """The SDK client, created on first use and reused by every thread afterwards."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._connect()
+        return self._client
+
+    def aclient(self):
+        """The async SDK client (its own connection pool); first used inside the running event loop."""
+        if self._aclient is None:
+            self._aclient = self._aconnect()
+        return self._aclient
+
+    def _connect(self):
+        return None
+
+    def _aconnect(self):
+        return None
+
+    def _embed(self, texts: list[str], query: bool) -> list[list[float]]:
+        raise NotImplementedError
+
+    async def _aembed(self, texts: list[str], query: bool) -> list[list[float]]:
+        # Providers without an async SDK path: the sync call in a worker thread
+        return await asyncio.to_thread(self._embed, texts, query)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed(texts, query=False)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text], query=True)[0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self._aembed([text], query=True))[0]
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Several query vectors in one API request (up to batch_size texts)."""
+        return await self._aembed(texts, query=True)
+
+    async def aclose(self) -> None:
+        client, self._aclient = self._aclient, None
+        close = getattr(client, "aclose", None) or getattr(client, "close", None)
+        if close:
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+
+    def describe(self) -> str:
+        return f"{self.name} {self.model} (dim={self.dim})"
+
+class OpenAIProvider(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(self, api_key: str, model: str = "text-embedding-3-small", dim: int = 1536):
+        super().__init__(model, dim)
+        self.api_key = api_key
+
+    def _connect(self):
+        from openai import OpenAI
+        return OpenAI(api_key=self.api_key, max_retries=0)  # retries are handled by call_with_retry
+
+    def _aconnect(self):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=self.api_key, max_retries=0)
+
+    def _embed(self, texts: list[str], query: bool) -> list[list[float]]:
+        resp = self.client().embeddings.create(input=texts, model=self.model)
+        return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+    async def _aembed(self, texts: list[str], query: bool) -> list[list[float]]:
+        resp = await self.aclient().embeddings.create(input=texts, model=self.model)
+        return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+    def describe(self) -> str:
+        return f"OpenAI {self.model}"
+
+class GeminiProvider(EmbeddingProvider):
+    name = "gemini"
+    batch_size, batch_tokens = 100, 20_000
+
+    def __init__(self, api_key: str, model: str = "gemini-embedding-001", dim: int = 1536):
+        super().__init__(model, dim)
+        self.api_key = api_key
+
+    def _connect(self):
+        from google import genai
+        return genai.Client(api_key=self.api_key)
+
+    def _aconnect(self):
+        return self.client().aio  # async view of the same client (same key and options)
+
+    def _config(self, query: bool):
+        from google.genai import types
+        return types.EmbedContentConfig(
+            task_type="RETRIEVAL_QUERY" if query else "RETRIEVAL_DOCUMENT",
+            output_dimensionality=self.dim,
+        )
+
+    def _embed(self, texts: list[str], query: bool) -> list[list[float]]:
+        result = self.client().models.embed_content(model=self.model, contents=texts, config=self._config(query))
+        return self._vectors(result)
+
+    async def _aembed(self, texts: list[str], query: bool) -> list[list[float]]:
+        result = await self.aclient().models.embed_content(model=self.model, contents=texts, config=self._config(query))
+        return self._vectors(result)
+
+    @staticmethod
+    def _vectors(result) -> list[list[float]]:
+        # result.embeddings: list of Embedding; each has .values (or is iterable)
+        out = []
+        for e in result.embeddings:
+            v = getattr(e, "values", e)
+            out.append(list(v) if not isinstance(v, list) else v)
+        return out
+
+    def describe(self) -> str:
+        return f"Gemini {self.model} (dim={self.dim})"
+
+def embed_fake(chunks: list[str], output_dim: int = 1536, latency_ms: float = 0.0) -> list[list[float]]:
+    """Deterministic offline vectors from sha-256 of each chunk (benchmarks/tests; no API calls)."""
+    if latency_ms:
+        time.sleep(latency_ms / 1000)
+    out = []
+    for c in chunks:
+        raw = hashlib.shake_256(c.encode()).digest(output_dim * 2)
+        out.append([v / 32768.0 - 1.0 for v in array("H", raw)])
+    return out
+
+class FakeProvider(EmbeddingProvider):
+    name = "fake"
+
+    def __init__(self, dim: int = 1536, latency_ms: float = 0.0):
+        super().__init__("fake", dim)
+        self.latency_ms = latency_ms
+
+    def _embed(self, texts: list[str], query: bool) -> list[list[float]]:
+        return embed_fake(texts, self.dim, self.latency_ms)
+
+    async def _aembed(self, texts: list[str], query: bool) -> list[list[float]]:
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        return embed_fake(texts, self.dim)
+
+    def describe(self) -> str:
+        return f"fake (dim={self.dim}, latency={self.latency_ms}ms per request)"
+
+def provider_from_env(default: str = "openai") -> EmbeddingProvider:
+    """Provider named by EMBEDDING_PROVIDER (default: default); ValueError on bad config or a missing key."""
+    name = get_env("EMBEDDING_PROVIDER", default).lower()
+    if name == "openai":
+        api_key = get_env("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("Missing env: OPENAI_API_KEY")
+        return OpenAIProvider(api_key, get_env("EMBEDDING_MODEL", "text-embedding-3-small"))
+    if name == "gemini":
+        api_key = get_env("GEMINI_API_KEY") or get_env("GOOGLE_API_KEY")
+        if not api_key:
+            raise ValueError("Missing env: GEMINI_API_KEY or GOOGLE_API_KEY")
+        return GeminiProvider(api_key, get_env("EMBEDDING_MODEL", "gemini-embedding-001"), int(get_env("EMBEDDING_DIM", "1536")))
+    if name == "fake":
+        return FakeProvider(int(get_env("EMBEDDING_DIM", "1536")), float(get_env("EMBED_FAKE_LATENCY_MS", "0")))
+    raise ValueError(f"EMBEDDING_PROVIDER must be openai, gemini or fake, got: {name}")
+
+class QueryCache:
+    """Query vectors keyed by (provider, model, dim, normalised question).
+
+    In-process LRU with a TTL (max_entries=0 disables it), optionally backed by Redis so replicas and
+    restarts share entries. Vectors are kept as float32 bytes (6 KB at 1536 dims). Redis errors are
+    counted and logged, never raised: a cache problem only costs an embedding call.
+    """
+
+    def __init__(self, max_entries: int = 5000, ttl: float = 86400, redis_url: str = "", prefix: str = "rag:qemb:"):
+        self.max_entries, self.ttl, self.prefix = max_entries, ttl, prefix
+        self._entries = OrderedDict()  # key -> (expires_at, float32 bytes)
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.hits = self.shared_hits = self.misses = self.evictions = self.errors = 0
+
+    @staticmethod
+    def normalise(text: str) -> str:
+        """NFKC, whitespace collapsed: 'What is  RAG?\n' and 'What is RAG?' share one entry."""
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    def key(self, provider: EmbeddingProvider, question: str) -> str:
+        raw = "\0".join((provider.name, provider.model, str(provider.dim), question))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> list[float] | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return array("f", entry[1]).tolist()
+            if entry:
+                del self._entries[key]
+        blob = None
+        if self._redis is not None:
+            try:
+                blob = self._redis.get(self.prefix + key)
+            except Exception as e:
+                self._redis_error("get", e)
+        with self._lock:
+            if blob is None:
+                self.misses += 1
+                return None
+            self.shared_hits += 1
+        self._put_local(key, blob)
+        return array("f", blob).tolist()
+
+    def put(self, key: str, vector: list[float]) -> None:
+        blob = array("f", vector).tobytes()
+        self._put_local(key, blob)
+        if self._redis is not None:
+            try:
+                self._redis.set(self.prefix + key, blob, ex=max(1, int(self.ttl)))
+            except Exception as e:
+                self._redis_error("set", e)
+
+    def _put_local(self, key: str, blob: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, blob)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _redis_error(self, op: str, e: Exception) -> None:
+        with self._lock:
+            self.errors += 1
+        print(f"Query cache: redis {op} failed: {e}", file=sys.stderr)
+
+    async def embed(self, provider: EmbeddingProvider, questions: list[str], embed_fn) -> list[list[float]]:
+        """Cached vectors of the normalised questions, in order.
+
+        The distinct misses are sent to await embed_fn(texts) in requests of at most provider.batch_size
+        texts, concurrently. Redis calls run in a worker thread.
+        """
+        texts = [self.normalise(q) for q in questions]
+        keys = [self.key(provider, t) for t in texts]
+        unique = dict(zip(keys, texts))
+
+        def lookup():
+            return {k: self.get(k) for k in unique}
+
+        found = await asyncio.to_thread(lookup) if self._redis is not None else lookup()
+        missing = [k for k, v in found.items() if v is None]
+        if missing:
+            batches = [missing[i : i + provider.batch_size] for i in range(0, len(missing), provider.batch_size)]
+            results = await asyncio.gather(*(embed_fn([unique[k] for k in b]) for b in batches))
+            # Keep the float32 values a later hit returns, so repeated queries rank identically
+            fresh = {k: array("f", v).tolist() for b, vectors in zip(batches, results) for k, v in zip(b, vectors)}
+
+            def store():
+                for k, v in fresh.items():
+                    self.put(k, v)
+
+            await asyncio.to_thread(store) if self._redis is not None else store()
+            found.update(fresh)
+        return [found[k] for k in keys]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "shared_hits": self.shared_hits,
+                    "misses": self.misses, "evictions": self.evictions, "errors": self.errors}
+
+class MicroBatcher:
+    """Coalesces embedding calls of concurrent requests into one provider request.
+
+    Texts queued within max_wait seconds of the first one, or until max_batch texts are waiting, are sent
+    together as embed_fn(texts) (duplicates once); each caller gets its own vectors back. A rate-limit,
+    server or connection error fails every caller of that batch; any other error (e.g. one invalid input)
+    resends the texts one per request, so only callers of a text that still fails get the error.
+    Event-loop only.
+    """
+
+    def __init__(self, embed_fn, max_batch: int = 32, max_wait: float = 0.005):
+        self.embed_fn, self.max_batch, self.max_wait = embed_fn, max(1, max_batch), max_wait
+        self._pending = []  # (text, future)
+        self._timer = None
+        self._tasks = set()  # batches in flight; the loop only keeps weak references to tasks
+        self.batches = self.texts = 0
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self._pending.append((text, future))
+            futures.append(future)
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+        if self._pending and self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return list(await asyncio.gather(*futures))
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self) -> None:
+        """Send what is still queued and wait for every batch in flight (shutdown)."""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _send(self, batch: list) -> None:
+        unique = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.texts += len(unique)
+        errors = {}
+        try:
+            vectors = dict(zip(unique, await self.embed_fn(unique)))
+        except Exception as e:
+            if len(unique) == 1 or is_retryable(e):
+                vectors, errors = {}, dict.fromkeys(unique, e)
+            else:
+                self.batches += len(unique)
+                results = await asyncio.gather(*(self.embed_fn([text]) for text in unique), return_exceptions=True)
+                vectors = {text: r[0] for text, r in zip(unique, results) if not isinstance(r, BaseException)}
+                errors = {text: r for text, r in zip(unique, results) if isinstance(r, BaseException)}
+        for text, future in batch:
+            if future.done():  # caller went away (client disconnect)
+                continue
+            if text in errors:
+                future.set_exception(errors[text])
+            else:
+                future.set_result(vectors[text])
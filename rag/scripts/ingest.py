@@ -1,24 +1,110 @@
 #!/usr/bin/env python3
 """
 RAG indexer: MinIO raw/ -> chunking -> embedding (OpenAI or Gemini) -> Qdrant rag_docs
-env: EMBEDDING_PROVIDER=openai|gemini,
+env: EMBEDDING_PROVIDER=openai|gemini|fake, see embedding_providers.py (shared with the backends)
      OpenAI: OPENAI_API_KEY, EMBEDDING_MODEL
      Gemini: GEMINI_API_KEY (or GOOGLE_API_KEY), EMBEDDING_MODEL=gemini-embedding-001
-     Common: MINIO_*, QDRANT_*, CHUNK_SIZE, CHUNK_OVERLAP
+     Common: MINIO_*, QDRANT_*, CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_UNIT=chars|tokens (estimated tokens)
+     Pipeline: list -> fetch -> extract -> chunk -> embed -> upsert run as generator stages joined by
+           bounded queues (PIPELINE_QUEUE_SIZE docs each), so peak memory follows batch size, not corpus size.
+           FETCH_WORKERS threads download objects; EXTRACT_WORKERS processes parse PDFs (0 = inline).
+     Fetch: objects are streamed in 1 MiB blocks and every response is closed and released; objects over
+           FETCH_SPOOL_MB (default 16) go to a temp file under FETCH_SPOOL_DIR (default system temp) that
+           pypdf reads by seeking and text files are decoded from incrementally.
+     Embedding: chunks from many documents are packed into requests of at most EMBED_BATCH_SIZE inputs /
+           EMBED_BATCH_TOKENS estimated tokens, EMBED_CONCURRENCY requests in flight, 429/5xx retried
+           up to EMBED_MAX_RETRIES times with exponential backoff (Retry-After honoured).
+     Upsert: batches of at most UPSERT_BATCH_SIZE points (default 256) / UPSERT_BATCH_BYTES estimated bytes
+           (default 4 MiB), UPSERT_CONCURRENCY (default 4) in flight. UPSERT_WAIT=false (default) returns once
+           Qdrant has logged a batch; before the alias switch the exact count is polled for up to
+           UPSERT_SETTLE_SECONDS (default 120). QDRANT_PREFER_GRPC=true uses gRPC on QDRANT_GRPC_PORT (6334).
+     Cache: EMBED_CACHE=true keeps chunk vectors in SQLite (EMBED_CACHE_PATH) keyed by
+           (provider, model, dim, sha256(chunk)), synced with MinIO EMBED_CACHE_KEY
+           (default cache/embeddings-{collection}.sqlite); only cache misses are sent to the API.
+           Uploaded only when entries were added or pruned; pruning runs on full rebuilds of every route.
+     Offline: SOURCE_DIR=<dir> reads <dir>/<MINIO_BUCKET>/... instead of MinIO, QDRANT_LOCATION=:memory:
+           uses in-process Qdrant, EMBEDDING_PROVIDER=fake returns deterministic vectors (see bench_ingest.py).
+     Dedup: DEDUP=minhash drops chunks whose MinHash Jaccard estimate vs. a chunk kept earlier in the
+           run is >= DEDUP_THRESHOLD (default 0.9); the kept point gets payload paths=[all sources].
+     Mode: INGEST_MODE=full (build a new collection version) | incremental (re-embed only new/changed
+           objects in the live version, delete vectors of removed objects). State per collection is kept
+           in MANIFEST_KEY (default manifests/{collection}.json in MINIO_BUCKET).
+     Routes: INGEST_ROUTES="raw/a/=rag_docs_a,raw/b/=rag_docs_b" (or "auto": every {MINIO_PREFIX}{id}/ ->
+           {QDRANT_COLLECTION}_{id}) indexes several collections in one run: the bucket is listed once, the
+           pipeline and cache (default cache/embeddings-shared.sqlite) are shared, and each collection keeps
+           its own alias, manifests/{collection}.json and dedup index. Unset = MINIO_PREFIX -> QDRANT_COLLECTION.
+     Checkpoints: every CHECKPOINT_INTERVAL seconds (default 30; 0 = off) and on failure/SIGTERM, progress
+           (version being written, objects whose points are all acknowledged) goes to checkpoints/{collection}.json.
+           A retried run younger than CHECKPOINT_MAX_AGE_HOURS (default 24) continues that version and skips
+           finished objects; the checkpoint is deleted once the manifest is saved.
+     Storage: QDRANT_QUANTIZATION=none|scalar (int8, 4x less RAM)|binary (32x), QDRANT_ON_DISK (float32
+           originals on disk), QDRANT_ON_DISK_PAYLOAD, HNSW_M, HNSW_EF_CONSTRUCT. Applied to new versions;
+           an incremental run converts the live version in place when they change (no re-embedding).
+     Payload: keyword indexes on doc_id/path/dirs/source, integer index on chunk_index (dirs = ancestor folders).
+           `ingest.py delete-path <key>...` / `ingest.py delete-prefix <folder/>...` remove those objects'
+           points (one filtered delete each) and manifest entries without a rebuild.
+     Watch: `ingest.py watch` stays up and runs incremental passes limited to the collections of changed
+           objects. WATCH_SOURCE=webhook takes MinIO bucket notifications on POST :WATCH_PORT/events (Bearer
+           WATCH_AUTH_TOKEN); poll lists the bucket every WATCH_POLL_SECONDS. Bursts are collected until quiet for
+           WATCH_DEBOUNCE_SECONDS (at most WATCH_MAX_DELAY_SECONDS); a full incremental pass runs at startup and
+           every WATCH_RESYNC_SECONDS. Clients, pools and the embedding cache stay open across passes; the cache
+           is uploaded at most every WATCH_CACHE_SYNC_SECONDS (default 600) and on shutdown.
+     Report: per-stage latency histograms (LATENCY_BUCKETS) and counters go into a JSON run report,
+           RUN_REPORT=minio (RUN_REPORT_KEY, default reports/{collection}/{started}.json)|stdout|off, and are
+           pushed to PUSHGATEWAY_URL (Prometheus text format) when set.
+     Sparse: SPARSE_VECTORS=bm25 (default) also stores a local BM25-style lexical vector per chunk as named
+           sparse vector "text" (IDF applied by Qdrant), for hybrid search in the backend; off = dense only.
+     Text cache: TEXT_CACHE=gzip (default)|zstd|off keeps extracted PDF text and page offsets in
+           {TEXT_CACHE_PREFIX}v<extractor version>/<etag>.json.gz (default prefix extracted/); a PDF whose ETag
+           is cached is neither downloaded nor parsed again, also in full rebuilds. Entries of PDFs removed
+           or replaced since the last manifest are deleted when the run finishes.
+     Blue/green: QDRANT_COLLECTION is a Qdrant alias. Full builds go into {collection}_v<UTC timestamp>;
+           after the point count is verified the alias is switched atomically. Versions older than
+           COLLECTION_RETENTION_HOURS (default 48) are deleted, except the live one. Every run or delete that
+           changes a collection also moves its {collection}__rev_<run id> alias, which backends key cached answers on.
 """
 import os
+import re
 import sys
+import json
 import uuid
+import time
+import queue
+import sqlite3
+import zlib
+import gzip
+import codecs
+import tempfile
 import hashlib
+import signal
+import resource
+import threading
+import multiprocessing
+import urllib.request
+from urllib.parse import unquote_plus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
+from types import SimpleNamespace
+from array import array
+from contextlib import contextmanager
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
 
 # Dependencies: pip install minio qdrant-client openai pypdf
-# For Gemini add: pip install google-genai
+# For Gemini add: pip install google-genai (certifi and urllib3 come with minio)
+import certifi
+import urllib3
 from minio import Minio
+from minio.error import S3Error
 from qdrant_client import QdrantClient
 from qdrant_client.http import models as qmodels
 from pypdf import PdfReader
 
+from embedding_providers import call_with_retry, provider_from_env
+
 def get_env(name: str, default: str = "") -> str:
     v = os.environ.get(name, default).strip()
     return v
@@ -30,180 +116,2023 @@ def require_env(name: str) -> str:
         sys.exit(1)
     return v
 
-def chunk_text(text: str, size: int = 500, overlap: int = 50) -> list[str]:
-    if not text or not text.strip():
-        return []
-    chunks = []
-    start = 0
-    text = text.replace("\r\n", "\n").strip()
-    while start < len(text):
-        end = start + size
-        chunk = text[start:end]
-        if chunk.strip():
-            chunks.append(chunk.strip())
-        start = end - overlap if overlap < size else end
-    return chunks
-
-def extract_text(data: bytes, key: str) -> str:
+CHUNKER_VERSION = 2
+# Places where a chunk may end, strongest first: before a Markdown heading, paragraph break,
+# sentence end, line break. A boundary's position is where the next unit starts (m.end()).
+BOUNDARY_RE = re.compile(
+    r"(?P<heading>\n+(?=#{1,6}\s))"
+    r"|(?P<para>\n[ \t]*\n\s*)"
+    r"|(?P<sentence>(?<=[.!?。！？])\s+)"
+    r"|(?P<line>\n)"
+)
+BOUNDARY_STRENGTH = {"heading": 4, "para": 3, "sentence": 2, "line": 1}
+WIDE_RE = re.compile(r"[\u2e80-\U0010ffff]")
+
+def measure(text: str, start: int, end: int, unit: str) -> int:
+    """Size of text[start:end] in chars, or estimated tokens (see estimate_tokens), without slicing."""
+    if unit == "chars":
+        return end - start
+    wide = sum(1 for _ in WIDE_RE.finditer(text, start, end))
+    return wide + (end - start - wide + 3) // 4
+
+def trim_span(text: str, start: int, end: int) -> tuple[int, int]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def split_long(text: str, start: int, end: int, size: int, overlap: int, unit: str) -> list[tuple[int, int]]:
+    """Cut one boundary-free unit (e.g. a huge paragraph) into ~size pieces at whitespace."""
+    per_char = max(1, end - start) / max(1, measure(text, start, end, unit))
+    step, back = max(1, int(size * per_char)), int(overlap * per_char)
+    spans = []
+    while start < end:
+        stop = min(end, start + step)
+        if stop < end:
+            ws = max(text.rfind(" ", start + step // 2, stop), text.rfind("\n", start + step // 2, stop))
+            stop = ws if ws > start else stop
+        spans.append(trim_span(text, start, stop))
+        if stop >= end:
+            break
+        nxt = stop - back
+        ws = text.find(" ", nxt, stop)
+        nxt = ws + 1 if 0 <= ws < stop else nxt
+        # A piece shorter than the overlap gets none, instead of the window creeping on by one char
+        start = nxt if nxt > start else stop
+    return spans
+
+def chunk_spans(text: str, size: int = 500, overlap: int = 50, unit: str = "chars") -> list[tuple[int, int]]:
+    """(start, end) offsets of chunks of at most ~size chars/tokens, cut at the strongest nearby boundary.
+
+    One regex pass finds the boundaries and their cumulative sizes; chunks are then packed
+    greedily from those offsets, preferring headings > paragraphs > sentences > lines in the back
+    half of each window (headings already after a fifth). Consecutive chunks share whole units
+    worth at most `overlap`, capped at half of size so every chunk moves the window forward.
+    Only the final chunk texts are ever sliced.
+    """
+    overlap = max(0, min(overlap, size // 2))
+    n = len(text)
+    pos, strength = [0], [0]
+    for m in BOUNDARY_RE.finditer(text):
+        if 0 < m.end() < n:
+            pos.append(m.end())
+            strength.append(BOUNDARY_STRENGTH[m.lastgroup])
+    pos.append(n)
+    strength.append(0)
+    cum = [0] * len(pos)
+    for k in range(1, len(pos)):
+        cum[k] = cum[k - 1] + measure(text, pos[k - 1], pos[k], unit)
+
+    spans = []
+    last = len(pos) - 1
+    i = j = 0
+    while i < last:
+        j = max(j, i + 1)
+        while j < last and cum[j + 1] - cum[i] <= size:
+            j += 1
+        if cum[j] - cum[i] > size:
+            spans.extend(split_long(text, pos[i], pos[j], size, overlap, unit))
+            i = j
+            continue
+        if j < last:
+            best = j
+            for k in range(j - 1, i, -1):
+                filled = cum[k] - cum[i]
+                if filled < size // 5:
+                    break
+                if (filled >= size // 2 or strength[k] == 4) and strength[k] > strength[best]:
+                    best = k
+            j = best
+        spans.append(trim_span(text, pos[i], pos[j]))
+        if j == last:
+            break
+        k = j
+        while k - 1 > i and cum[j] - cum[k - 1] <= overlap:
+            k -= 1
+        i = k
+    return [(a, b) for a, b in spans if a < b]
+
+def chunk_text(text: str, size: int = 500, overlap: int = 50, unit: str = "chars") -> list[str]:
+    return [text[a:b] for a, b in chunk_spans(text, size, overlap, unit)]
+
+EXTRACTOR_VERSION = 2  # bump when extract_text output changes; invalidates the extracted-text cache
+
+def decode_file(path: str, block: int = 1 << 20) -> str:
+    """UTF-8 text of a spooled file, decoded block by block (never holds the raw bytes and the text at once)."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parts = []
+    with open(path, "rb") as f:
+        while block_data := f.read(block):
+            parts.append(decoder.decode(block_data))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
+def normalize_text(text: str) -> str:
+    return text.replace("\r\n", "\n")
+
+def extract_text(data: bytes | str, key: str) -> tuple[str, list[int]]:
+    """Normalized text of an object and the char offset where each PDF page starts in it (empty for other files).
+
+    data is the object's bytes, or the path of the temp file it was spooled to (large objects).
+    Offsets index the normalized text, the same text chunk spans index.
+    """
     ext = (key.split(".")[-1] or "").lower()
     if ext == "pdf":
         try:
-            reader = PdfReader(BytesIO(data))
-            return "\n".join(p.extract_text() or "" for p in reader.pages)
+            # pypdf seeks in the file instead of loading it when given an open file
+            with open(data, "rb") if isinstance(data, str) else BytesIO(data) as f:
+                reader = PdfReader(f)
+                parts, starts, pos = [], [], 0
+                for p in reader.pages:
+                    starts.append(pos)
+                    parts.append(normalize_text(p.extract_text() or ""))
+                    pos += len(parts[-1]) + 1
+            return "\n".join(parts), starts
         except Exception as e:
             print(f"PDF error {key}: {e}", file=sys.stderr)
-            return ""
+            return "", []
     if ext in ("txt", "md", "text"):
         try:
-            return data.decode("utf-8", errors="replace")
+            return normalize_text(decode_file(data) if isinstance(data, str) else data.decode("utf-8", errors="replace")), []
         except Exception as e:
             print(f"Decode error {key}: {e}", file=sys.stderr)
-            return ""
+            return "", []
     try:
-        return data.decode("utf-8", errors="replace")
+        return normalize_text(decode_file(data) if isinstance(data, str) else data.decode("utf-8", errors="replace")), []
     except Exception:
-        return ""
-
-def embed_openai(chunks: list[str], model: str, api_key: str) -> list[list[float]]:
-    from openai import OpenAI
-    client = OpenAI(api_key=api_key)
-    resp = client.embeddings.create(input=chunks, model=model)
-    sorted_data = sorted(resp.data, key=lambda d: d.index)
-    return [d.embedding for d in sorted_data]
-
-def embed_gemini(chunks: list[str], model: str, api_key: str, output_dim: int = 1536) -> list[list[float]]:
-    from google import genai
-    from google.genai import types
-    client = genai.Client(api_key=api_key)
-    result = client.models.embed_content(
-        model=model,
-        contents=chunks,
-        config=types.EmbedContentConfig(
-            task_type="RETRIEVAL_DOCUMENT",
-            output_dimensionality=output_dim,
-        ),
-    )
-    # result.embeddings: list of Embedding; each has .values (or is iterable)
-    out = []
-    for e in result.embeddings:
-        v = getattr(e, "values", e)
-        out.append(list(v) if not isinstance(v, list) else v)
-    return out
+        return "", []
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class StageStats:
+    """Busy seconds, item counts and a call latency histogram per pipeline stage, plus plain counters (thread-safe)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.items = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.max = defaultdict(float)
+        self.buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))  # non-cumulative counts per bound
+        self.counters = defaultdict(int)
+
+    def reset(self) -> None:
+        with self.lock:
+            for d in (self.seconds, self.items, self.calls, self.max, self.buckets, self.counters):
+                d.clear()
+
+    def add(self, stage: str, seconds: float, items: int = 1) -> None:
+        """One call of stage that took seconds and handled items."""
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.items[stage] += items
+            self.calls[stage] += 1
+            self.max[stage] = max(self.max[stage], seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[stage][i] += 1
+                    break
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def timed(self, stage: str, items: int = 1):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0, items)
+
+    def summary(self) -> str:
+        return ", ".join(f"{k} {self.seconds[k]:.1f}s/{self.items[k]}" for k in self.seconds)
+
+    def quantile(self, stage: str, q: float) -> float:
+        """Upper bound of the histogram bucket holding the q-quantile call (max for the overflow bucket)."""
+        counts, rank, seen = self.buckets[stage], q * self.calls[stage], 0
+        for bound, n in zip(LATENCY_BUCKETS, counts):
+            seen += n
+            if seen >= rank and seen:
+                return min(bound, self.max[stage])
+        return self.max[stage]
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "stages": {k: {
+                    "busy_s": round(self.seconds[k], 3),
+                    "items": self.items[k],
+                    "calls": self.calls[k],
+                    "p50_s": round(self.quantile(k, 0.5), 3),
+                    "p95_s": round(self.quantile(k, 0.95), 3),
+                    "max_s": round(self.max[k], 3),
+                    # [upper bound in seconds, calls]; the last entry counts calls above the largest bound
+                    "buckets": [list(b) for b in zip(LATENCY_BUCKETS, self.buckets[k])]
+                               + [["+Inf", self.calls[k] - sum(self.buckets[k])]],
+                } for k in self.seconds},
+                "counters": dict(self.counters),
+            }
+
+    def prometheus(self, labels: str) -> str:
+        """Text exposition format; labels is a rendered label list like 'collection="rag_docs"'."""
+        lines = ["# TYPE rag_ingest_stage_seconds histogram"]
+        with self.lock:
+            for k in self.seconds:
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, self.buckets[k]):
+                    cumulative += n
+                    lines.append(f'rag_ingest_stage_seconds_bucket{{{labels},stage="{k}",le="{bound}"}} {cumulative}')
+                lines.append(f'rag_ingest_stage_seconds_bucket{{{labels},stage="{k}",le="+Inf"}} {self.calls[k]}')
+                lines.append(f'rag_ingest_stage_seconds_sum{{{labels},stage="{k}"}} {self.seconds[k]:.6f}')
+                lines.append(f'rag_ingest_stage_seconds_count{{{labels},stage="{k}"}} {self.calls[k]}')
+            lines.append("# TYPE rag_ingest_stage_items_total counter")
+            lines += [f'rag_ingest_stage_items_total{{{labels},stage="{k}"}} {v}' for k, v in self.items.items()]
+            lines.append("# TYPE rag_ingest_events_total counter")
+            lines += [f'rag_ingest_events_total{{{labels},name="{k}"}} {v}' for k, v in self.counters.items()]
+        return "\n".join(lines) + "\n"
+
+STATS = StageStats()
+
+def peak_rss_mb() -> float:
+    """Peak RSS of this process and its (extraction) children, MB (ru_maxrss is KB on Linux)."""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+class LocalObjectStore:
+    """Directory-backed stand-in for the Minio client calls ingest uses: <root>/<bucket>/<key>."""
+
+    class Response(BytesIO):
+        def release_conn(self) -> None:
+            pass
 
-def main():
-    provider = get_env("EMBEDDING_PROVIDER", "openai").lower()
-    if provider not in ("openai", "gemini"):
-        print(f"EMBEDDING_PROVIDER must be openai or gemini, got: {provider}", file=sys.stderr)
+        def stream(self, amt: int = 65536):
+            while chunk := self.read(amt):
+                yield chunk
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def bucket_exists(self, bucket: str) -> bool:
+        return os.path.isdir(os.path.join(self.root, bucket))
+
+    def make_bucket(self, bucket: str) -> None:
+        os.makedirs(os.path.join(self.root, bucket), exist_ok=True)
+
+    def list_objects(self, bucket: str, prefix: str = "", recursive: bool = True):
+        base = os.path.join(self.root, bucket)
+        for dirpath, _, files in os.walk(base):
+            for name in sorted(files):
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, base).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    st = os.stat(path)
+                    yield SimpleNamespace(
+                        object_name=key,
+                        etag=f"{st.st_size:x}-{st.st_mtime_ns:x}",
+                        size=st.st_size,
+                        last_modified=datetime.fromtimestamp(st.st_mtime, timezone.utc),
+                    )
+
+    def get_object(self, bucket: str, key: str):
+        with open(self._path(bucket, key), "rb") as f:
+            return self.Response(f.read())
+
+    def put_object(self, bucket: str, key: str, data, length: int, content_type: str = "") -> None:
+        os.makedirs(os.path.dirname(self._path(bucket, key)), exist_ok=True)
+        with open(self._path(bucket, key), "wb") as f:
+            f.write(data.read(length))
+
+    def fget_object(self, bucket: str, key: str, path: str) -> None:
+        with open(self._path(bucket, key), "rb") as src, open(path, "wb") as dst:
+            dst.write(src.read())
+
+    def fput_object(self, bucket: str, key: str, path: str, content_type: str = "") -> None:
+        with open(path, "rb") as src:
+            data = src.read()
+        self.put_object(bucket, key, BytesIO(data), len(data))
+
+    def remove_object(self, bucket: str, key: str) -> None:
+        try:
+            os.remove(self._path(bucket, key))
+        except FileNotFoundError:
+            pass
+
+def is_missing(e: Exception) -> bool:
+    """NoSuchKey from MinIO or a missing file from LocalObjectStore."""
+    return isinstance(e, FileNotFoundError) or (isinstance(e, S3Error) and e.code == "NoSuchKey")
+
+@dataclass
+class Doc:
+    """One MinIO object travelling through the pipeline; each stage fills in the next field."""
+    obj: object
+    collection: str = ""  # Qdrant collection (version) the points go to
+    data: bytes = b""
+    spool: str = ""  # temp file holding the object instead of data (objects over the spool threshold)
+    text: str = ""
+    chunks: list[str] = field(default_factory=list)
+    spans: list[tuple[int, int]] = field(default_factory=list)  # char offsets of chunks in the text
+    indices: list[int] = field(default_factory=list)  # chunk_index of each chunk kept after dedup
+    vectors: list[list[float]] = field(default_factory=list)
+    pages: list[int] = field(default_factory=list)  # char offset of each PDF page in text
+    cached: bool = False  # text came from the extracted-text cache; fetch and extract were skipped
+    missing: bool = False  # deleted between listing and fetch; handled like a removed object
+    merged_into: list[tuple[str, int]] = field(default_factory=list)  # (kept path, chunk_index) per dropped chunk
+
+    @property
+    def key(self) -> str:
+        return self.obj.object_name
+
+_END = object()
+
+def stage(items, maxsize: int):
+    """Run an upstream generator in its own thread, handing items over through a bounded queue.
+
+    The producer blocks once maxsize items are waiting, so a slow consumer throttles every
+    stage before it. Exceptions raised upstream are re-raised in the consumer.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def pump():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        q.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            q.put(_END)
+        except BaseException as e:
+            q.put(e)
+
+    threading.Thread(target=pump, daemon=True).start()
+    try:
+        while True:
+            item = q.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def bounded_map(submit, items, max_pending: int):
+    """Yield (item, result) of submit(item) futures in completion order, at most max_pending in flight.
+
+    Completion order lets small objects overtake a large one instead of queueing behind it.
+    """
+    pending = {}
+
+    def drain(return_when):
+        done, _ = wait(pending, return_when=return_when)
+        for fut in done:
+            yield pending.pop(fut), fut.result()
+
+    for item in items:
+        pending[submit(item)] = item
+        if len(pending) >= max_pending:
+            yield from drain(FIRST_COMPLETED)
+    while pending:
+        yield from drain(FIRST_COMPLETED)
+
+class TextCache:
+    """Extracted PDF text (+ page offsets) stored in the bucket under {prefix}v{EXTRACTOR_VERSION}/{etag}.json.gz|.zst.
+
+    Keyed by content (ETag), so unchanged PDFs skip download and parsing in every later run,
+    including full rebuilds after a chunker or embedding change. Other files are cheap to decode
+    and are not cached.
+    """
+
+    def __init__(self, minio_client, bucket: str, prefix: str, compression: str):
+        self.minio_client, self.bucket = minio_client, bucket
+        self.prefix = prefix.rstrip("/") + "/"
+        self.compression = compression
+        if compression == "zstd":
+            import zstandard
+            self.compress, self.decompress = zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+        else:
+            self.compress, self.decompress = gzip.compress, gzip.decompress
+
+    def handles(self, obj) -> bool:
+        return obj.object_name.lower().endswith(".pdf") and bool((obj.etag or "").strip('"'))
+
+    def key(self, obj) -> str:
+        ext = "zst" if self.compression == "zstd" else "gz"
+        return f"{self.prefix}v{EXTRACTOR_VERSION}/{obj.etag.strip(chr(34))}.json.{ext}"
+
+    def discard(self, etags) -> None:
+        """Delete the entries of content no object has any more (removed or replaced PDFs). Failures only warn."""
+        for etag in etags:
+            for ext in ("gz", "zst"):  # whichever TEXT_CACHE wrote it
+                try:
+                    self.minio_client.remove_object(self.bucket, f"{self.prefix}v{EXTRACTOR_VERSION}/{etag}.json.{ext}")
+                except Exception as e:
+                    print(f"Text cache delete failed for {etag}: {e}", file=sys.stderr)
+
+    def get(self, obj) -> tuple[str, list[int]] | None:
+        try:
+            resp = self.minio_client.get_object(self.bucket, self.key(obj))
+            try:
+                entry = json.loads(self.decompress(resp.read()))
+            finally:
+                resp.close()
+                resp.release_conn()
+        except Exception as e:
+            if not is_missing(e):
+                print(f"Text cache read failed for {obj.object_name} (re-extracting): {e}", file=sys.stderr)
+            return None
+        return entry["text"], entry["pages"]
+
+    def put(self, obj, text: str, pages: list[int]) -> None:
+        data = self.compress(json.dumps({"path": obj.object_name, "pages": pages, "text": text}, ensure_ascii=False).encode())
+        try:
+            self.minio_client.put_object(self.bucket, self.key(obj), BytesIO(data), len(data), content_type="application/json")
+            STATS.count("text_cache_bytes", len(data))
+        except Exception as e:
+            print(f"Text cache write failed for {obj.object_name}: {e}", file=sys.stderr)
+
+def text_cache_from_env(minio_client, bucket: str) -> TextCache | None:
+    mode = get_env("TEXT_CACHE", "gzip").lower()
+    if mode not in ("gzip", "zstd", "off"):
+        print(f"TEXT_CACHE must be gzip, zstd or off, got: {mode}", file=sys.stderr)
+        sys.exit(1)
+    if mode == "off":
+        return None
+    try:
+        return TextCache(minio_client, bucket, get_env("TEXT_CACHE_PREFIX", "extracted/"), mode)
+    except ImportError:
+        print("TEXT_CACHE=zstd needs: pip install zstandard", file=sys.stderr)
         sys.exit(1)
 
-    endpoint = get_env("MINIO_ENDPOINT", "minio.devops.svc.cluster.local")
-    port = int(get_env("MINIO_PORT", "9000"))
-    use_ssl = get_env("MINIO_USE_SSL", "false").lower() == "true"
-    access_key = require_env("MINIO_ACCESS_KEY")
-    secret_key = require_env("MINIO_SECRET_KEY")
-    bucket = get_env("MINIO_BUCKET", "rag-docs")
-    prefix = get_env("MINIO_PREFIX", "raw/").rstrip("/") + "/"
+def pdf_etags(objects: dict) -> set[str]:
+    """ETags of the PDFs among manifest objects {path: {"fingerprint": ...}} (what the text cache is keyed by)."""
+    return {e["fingerprint"].get("etag") for k, e in objects.items()
+            if k.lower().endswith(".pdf") and e.get("fingerprint", {}).get("etag")}
 
-    qdrant_host = get_env("QDRANT_HOST", "qdrant")
-    qdrant_port = int(get_env("QDRANT_PORT", "6333"))
-    collection = get_env("QDRANT_COLLECTION", "rag_docs")
+def read_object(minio_client, bucket: str, key: str, spool_dir: str = "", spool_bytes: int = 0,
+                size: int = 0) -> tuple[bytes, str]:
+    """Stream an object in blocks; (bytes, "") or, when size exceeds spool_bytes, (b"", temp file path).
 
-    chunk_size = int(get_env("CHUNK_SIZE", "500"))
-    chunk_overlap = int(get_env("CHUNK_OVERLAP", "50"))
+    The response is always closed and its connection returned to the pool, also on errors, so
+    long runs do not exhaust urllib3's connections.
+    """
+    resp = minio_client.get_object(bucket, key)
+    try:
+        if spool_dir and size > spool_bytes:
+            fd, path = tempfile.mkstemp(dir=spool_dir, suffix=os.path.splitext(key)[1])
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for block in resp.stream(1 << 20):
+                        f.write(block)
+            except BaseException:
+                os.remove(path)
+                raise
+            return b"", path
+        return b"".join(resp.stream(1 << 20)), ""
+    finally:
+        resp.close()
+        resp.release_conn()
 
-    if provider == "openai":
-        api_key = require_env("OPENAI_API_KEY")
-        embedding_model = get_env("EMBEDDING_MODEL", "text-embedding-3-small")
-        embed_fn = lambda c: embed_openai(c, embedding_model, api_key)
-        print(f"Embedding: OpenAI {embedding_model}")
-    else:
-        api_key = get_env("GEMINI_API_KEY") or get_env("GOOGLE_API_KEY")
-        if not api_key:
-            print("Missing env: GEMINI_API_KEY or GOOGLE_API_KEY", file=sys.stderr)
-            sys.exit(1)
-        embedding_model = get_env("EMBEDDING_MODEL", "gemini-embedding-001")
-        output_dim = int(get_env("EMBEDDING_DIM", "1536"))
-        embed_fn = lambda c: embed_gemini(c, embedding_model, api_key, output_dim)
-        print(f"Embedding: Gemini {embedding_model} (dim={output_dim})")
-
-    minio_client = Minio(
-        f"{endpoint}:{port}",
-        access_key=access_key,
-        secret_key=secret_key,
-        secure=use_ssl,
-    )
-    qdrant_client = QdrantClient(host=qdrant_host, port=qdrant_port, check_compatibility=False)
+def fetch_docs(minio_client, bucket: str, objects, targets: dict, pool: ThreadPoolExecutor, max_pending: int,
+               text_cache: TextCache | None = None, spool_dir: str = "", spool_bytes: int = 0):
+    def fetch(obj):
+        doc = Doc(obj=obj, collection=targets[obj.object_name])
+        if text_cache and text_cache.handles(obj):
+            hit = text_cache.get(obj)
+            if hit is not None:
+                doc.text, doc.pages = hit
+                doc.cached = True
+                STATS.count("text_cache_hits")
+                return doc
+            STATS.count("text_cache_misses")
+        with STATS.timed("fetch"):
+            try:
+                doc.data, doc.spool = read_object(minio_client, bucket, obj.object_name, spool_dir, spool_bytes, obj.size or 0)
+            except (S3Error, FileNotFoundError) as e:
+                if not is_missing(e):
+                    raise
+                print(f"  {obj.object_name}: deleted since listing, treated as removed")
+                doc.missing = True
+                return doc
+        STATS.count("bytes_fetched", os.path.getsize(doc.spool) if doc.spool else len(doc.data))
+        if doc.spool:
+            STATS.count("objects_spooled")
+        return doc
 
-    if not minio_client.bucket_exists(bucket):
-        minio_client.make_bucket(bucket)
-        print(f"Created bucket {bucket}.")
+    for _, doc in bounded_map(lambda o: pool.submit(fetch, o), objects, max_pending):
+        yield doc
+
+def extract_timed(data: bytes | str, key: str) -> tuple[str, list[int], float]:
+    """extract_text plus its duration, measured where it runs (possibly a pool process)."""
+    t0 = time.perf_counter()
+    text, pages = extract_text(data, key)
+    return text, pages, time.perf_counter() - t0
+
+def extract_docs(docs, pool: ProcessPoolExecutor | None, max_pending: int, text_cache: TextCache | None = None):
+    """Extract text; PDFs go to the process pool (pypdf is CPU-bound and holds the GIL). Cached docs pass through."""
+    def submit(doc):
+        if doc.cached or doc.missing:
+            fut = Future()
+            fut.set_result((doc.text, doc.pages, None))
+            return fut
+        # A spooled object goes to the pool process as its path, not pickled bytes
+        source = doc.spool or doc.data
+        if pool is not None and doc.key.lower().endswith(".pdf"):
+            return pool.submit(extract_timed, source, doc.key)
+        fut = Future()
+        fut.set_result(extract_timed(source, doc.key))
+        return fut
+
+    for doc, (text, pages, seconds) in bounded_map(submit, docs, max_pending):
+        if seconds is not None:
+            STATS.add("extract", seconds)
+            STATS.count("pdf_pages", len(pages))
+            if text_cache and pages and text_cache.handles(doc.obj):
+                text_cache.put(doc.obj, text, pages)
+        doc.data = b""
+        if doc.spool:
+            os.remove(doc.spool)
+            doc.spool = ""
+        if doc.key.lower().endswith(".pdf") and not pages and not doc.missing:
+            # A failed parse (even an empty PDF has page offsets) is dropped like a failed embedding: the old
+            # manifest entry and vectors stay, so it is not cached as empty and is retried next run
+            STATS.count("extract_failed")
+            print(f"  {doc.key}: not indexed (PDF parse failed), retried next run", file=sys.stderr)
+            continue
+        STATS.count("chars_extracted", len(text))
+        doc.text, doc.pages = text, pages
+        yield doc
+
+def chunk_docs(docs, size: int, overlap: int, unit: str):
+    for doc in docs:
+        with STATS.timed("chunk"):
+            doc.spans = chunk_spans(doc.text, size=size, overlap=overlap, unit=unit)
+            doc.chunks = [doc.text[a:b] for a, b in doc.spans]
+            doc.indices = list(range(len(doc.spans)))
+            doc.text = ""
+        STATS.count("chunks", len(doc.chunks))
+        yield doc
+
+class NearDupIndex:
+    """Near-duplicate lookup over the chunks kept so far in this run.
+
+    Signatures are one-permutation MinHash: every 5-char shingle of the whitespace-normalised,
+    lowercased text is hashed once (crc32) into one of 32 bins, keeping the minimum per bin.
+    LSH over 8 bands of 4 bins finds candidates; a candidate counts as a duplicate when the
+    estimated Jaccard similarity (share of equal bins) is at least `threshold`.
+    """
+    BINS, BANDS, SHINGLE = 32, 8, 5
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.buckets = {}  # (band, band values) -> [(signature, owner)]
+
+    def signature(self, text: str) -> array:
+        norm = " ".join(text.lower().split())
+        sig = [0xFFFFFFFF] * self.BINS
+        for i in range(max(1, len(norm) - self.SHINGLE + 1)):
+            h = zlib.crc32(norm[i : i + self.SHINGLE].encode())
+            b, v = h % self.BINS, h // self.BINS
+            if v < sig[b]:
+                sig[b] = v
+        # Densify: an empty bin borrows the next non-empty bin's value so short texts still compare
+        filled = [v for v in sig if v != 0xFFFFFFFF] or [0]
+        for b in range(self.BINS):
+            if sig[b] == 0xFFFFFFFF:
+                sig[b] = next((sig[(b + d) % self.BINS] for d in range(1, self.BINS) if sig[(b + d) % self.BINS] != 0xFFFFFFFF), filled[0])
+        return array("I", sig)
+
+    def find_or_add(self, text: str, owner):
+        """Return the owner of a near-duplicate already kept, or remember this chunk and return None."""
+        sig = self.signature(text)
+        rows = self.BINS // self.BANDS
+        keys = [(band, sig[band * rows : (band + 1) * rows].tobytes()) for band in range(self.BANDS)]
+        for key in keys:
+            for other, other_owner in self.buckets.get(key, ()):
+                if sum(a == b for a, b in zip(sig, other)) >= self.threshold * self.BINS:
+                    return other_owner
+        for key in keys:
+            self.buckets.setdefault(key, []).append((sig, owner))
+        return None
+
+def dedup_docs(docs, threshold: float):
+    """Drop chunks that nearly duplicate one kept earlier in the run (before paying to embed them).
+
+    Each collection has its own index, so a chunk is only merged with copies that end up in the
+    same collection. doc.merged_into records the kept chunk for every dropped one, so the kept
+    point can list all its sources.
+    """
+    indexes = defaultdict(lambda: NearDupIndex(threshold))
+    for doc in docs:
+        keep = []
+        index = indexes[doc.collection]
+        with STATS.timed("dedup"):
+            for n, (chunk, idx) in enumerate(zip(doc.chunks, doc.indices)):
+                owner = index.find_or_add(chunk, (doc.key, idx))
+                if owner is None:
+                    keep.append(n)
+                else:
+                    doc.merged_into.append(owner)
+        if len(keep) < len(doc.chunks):
+            print(f"  {doc.key}: dropped {len(doc.chunks) - len(keep)} near-duplicate chunks")
+            doc.chunks = [doc.chunks[n] for n in keep]
+            doc.spans = [doc.spans[n] for n in keep]
+            doc.indices = [doc.indices[n] for n in keep]
+        yield doc
+
+def set_duplicate_paths(qdrant_client, collection: str, duplicates: dict, batch_size: int = 100) -> None:
+    """Write payload paths=[own path, duplicate paths...] on every kept chunk that absorbed copies."""
+    ops = [
+        qmodels.SetPayloadOperation(
+            set_payload=qmodels.SetPayload(payload={"paths": sorted({key} | paths)}, points=[point_id(key, idx)])
+        )
+        for (key, idx), paths in duplicates.items()
+    ]
+    for i in range(0, len(ops), batch_size):
+        qdrant_client.batch_update_points(collection_name=collection, update_operations=ops[i : i + batch_size])
+
+# Per-request limits: OpenAI accepts 2048 inputs / 300k tokens, Gemini batchEmbedContents 100 inputs
+def estimate_tokens(text: str) -> int:
+    """Rough token count without a tokenizer: ~4 chars per token for Latin text, ~1 per CJK/Hangul char."""
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+def count_retry(status: int | None) -> None:
+    STATS.count("embed_retries")
+    if status == 429:
+        STATS.count("embed_rate_limited")
+
+def chunk_digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
 
-    # Drop and recreate collection: vectors for files deleted from MinIO are removed (full sync)
+class EmbeddingCache:
+    """Content-addressed chunk vectors in SQLite: (provider, model, dim, sha256(text)) -> float32 blob."""
+
+    def __init__(self, path: str, provider: str, model: str, dim: int):
+        self.scope = (provider, model, dim)
+        self.lock = threading.Lock()
+        self.run_at = int(time.time())
+        self.hits = self.misses = self.added = 0
+        self.unsaved = 0  # rows added or pruned since the file was last uploaded
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " provider TEXT, model TEXT, dim INTEGER, sha256 TEXT, vector BLOB, used_at INTEGER,"
+            " PRIMARY KEY (provider, model, dim, sha256))"
+        )
+
+    def get_many(self, digests: list[str]) -> dict[str, list[float]]:
+        found = {}
+        unique = list(dict.fromkeys(digests))
+        with self.lock:
+            for i in range(0, len(unique), 500):
+                part = unique[i : i + 500]
+                rows = self.conn.execute(
+                    f"SELECT sha256, vector FROM embeddings WHERE provider=? AND model=? AND dim=?"
+                    f" AND sha256 IN ({','.join('?' * len(part))})",
+                    (*self.scope, *part),
+                ).fetchall()
+                for digest, blob in rows:
+                    vec = array("f")
+                    vec.frombytes(blob)
+                    found[digest] = vec.tolist()
+            self.conn.executemany(
+                "UPDATE embeddings SET used_at=? WHERE provider=? AND model=? AND dim=? AND sha256=?",
+                [(self.run_at, *self.scope, d) for d in found],
+            )
+            self.hits += sum(1 for d in digests if d in found)
+            self.misses += sum(1 for d in digests if d not in found)
+        return found
+
+    def put_many(self, items: list[tuple[str, list[float]]]) -> None:
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)",
+                [(*self.scope, d, array("f", vec).tobytes(), self.run_at) for d, vec in items],
+            )
+            self.conn.commit()
+            self.added += len(items)
+            self.unsaved += len(items)
+
+    def prune(self, max_age_days: int) -> int:
+        """Drop vectors no run has used for max_age_days (chunks of deleted/edited documents).
+
+        Only valid after a run that looked up every live chunk: incremental runs leave used_at of
+        unchanged documents' vectors untouched.
+        """
+        with self.lock:
+            cur = self.conn.execute("DELETE FROM embeddings WHERE used_at < ?", (self.run_at - max_age_days * 86400,))
+            self.conn.commit()
+            self.unsaved += cur.rowcount
+            return cur.rowcount
+
+    def start_run(self) -> None:
+        """Stamp lookups/inserts from now on with the current time and reset the per-run counters (watch passes)."""
+        with self.lock:
+            self.run_at = int(time.time())
+            self.hits = self.misses = self.added = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+def load_embedding_cache(minio_client, bucket: str, key: str, path: str, provider: str, model: str, dim: int) -> EmbeddingCache:
+    if key:
+        try:
+            minio_client.fget_object(bucket, key, path)
+            print(f"Embedding cache: loaded {bucket}/{key}")
+        except (S3Error, FileNotFoundError) as e:
+            if not is_missing(e):
+                raise
+            print(f"Embedding cache: {bucket}/{key} not found, starting empty")
+    return EmbeddingCache(path, provider, model, dim)
+
+def save_embedding_cache(cache: EmbeddingCache, minio_client, bucket: str, key: str, path: str, max_age_days: int,
+                         prune: bool = False, upload: bool = True) -> None:
+    pruned = cache.prune(max_age_days) if prune else 0
+    print(f"Embedding cache: {cache.hits} hits, {cache.misses} misses, {cache.added} added, {pruned} stale entries pruned")
+    if upload:
+        upload_embedding_cache(cache, minio_client, bucket, key, path)
+
+def upload_embedding_cache(cache: EmbeddingCache, minio_client, bucket: str, key: str, path: str) -> None:
+    if not key or not cache.unsaved:
+        return  # nothing new: the copy in MinIO is still current
     try:
-        qdrant_client.delete_collection(collection_name=collection)
-        print(f"Deleted collection {collection}.")
+        # Every write is committed, so the file is consistent while the connection stays open
+        with cache.lock:
+            minio_client.fput_object(bucket, key, path, content_type="application/vnd.sqlite3")
+            cache.unsaved = 0
     except Exception as e:
-        print(f"Delete collection (may not exist): {e}")
+        print(f"Embedding cache upload failed (next run starts colder): {e}", file=sys.stderr)
+
+def embed_docs(docs, embed_fn, batch_size: int, batch_tokens: int, concurrency: int, retries: int,
+               cache: EmbeddingCache | None = None):
+    """Embed chunks of many docs in shared, provider-sized batches with `concurrency` requests in flight.
+
+    Each batch is a list of (doc, chunk_index) slots, so returned vectors go straight back to
+    doc.vectors[chunk_index]. A doc is yielded once all its chunks are embedded. A batch that still
+    fails after retries is split per doc and resent; a doc whose own chunks fail is dropped (and
+    retried next run). Identical chunk texts are sent once per run, and with a cache only chunks
+    whose vector is not cached are sent at all.
+    """
+    remaining = {}  # id(doc) -> chunks still waiting for a vector
+    failed = set()
+    pending = {}  # future -> its (doc, chunk_index) slots
+    followers = {}  # digest of a chunk in flight -> other slots with the same text
+    slots, slot_tokens = [], 0
+
+    def submit(batch):
+        texts = [doc.chunks[i] for doc, i in batch]
+        label = f"{len(texts)} chunks from {len({id(d) for d, _ in batch})} docs"
+        pending[pool.submit(timed_embed, texts, label)] = batch
+
+    def timed_embed(texts, label):
+        with STATS.timed("embed", len(texts)):
+            return call_with_retry(embed_fn, texts, retries, label, on_retry=count_retry)
+
+    def resolve(doc, i, vec):
+        if vec is not None:
+            doc.vectors[i] = vec
+        remaining[id(doc)] -= 1
+        if remaining[id(doc)] == 0:
+            del remaining[id(doc)]
+            if id(doc) in failed:
+                failed.discard(id(doc))
+            else:
+                yield doc
+
+    def harvest(timeout):
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for fut in done:
+            batch = pending.pop(fut)
+            try:
+                vectors = fut.result()
+                if len(vectors) != len(batch):
+                    raise ValueError(f"got {len(vectors)} vectors for {len(batch)} chunks")
+                if cache:
+                    cache.put_many([(chunk_digest(doc.chunks[i]), vec) for (doc, i), vec in zip(batch, vectors)])
+            except Exception as e:
+                by_doc = {}
+                for doc, i in batch:
+                    by_doc.setdefault(id(doc), []).append((doc, i))
+                if len(by_doc) > 1:
+                    # Isolate the offending document instead of failing its batch neighbours
+                    for sub in by_doc.values():
+                        submit(sub)
+                    continue
+                vectors = [None] * len(batch)
+                STATS.count("embed_failed_chunks", len(batch))
+                print(f"Embedding error for {batch[0][0].key}: {e}", file=sys.stderr)
+            for (doc, i), vec in zip(batch, vectors):
+                same = followers.pop(chunk_digest(doc.chunks[i]), [])
+                for d, j in [(doc, i)] + same:
+                    if vec is None:
+                        failed.add(id(d))
+                    yield from resolve(d, j, vec)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for doc in docs:
+            if not doc.chunks:
+                yield doc
+                continue
+            doc.vectors = [None] * len(doc.chunks)
+            digests = [chunk_digest(c) for c in doc.chunks]
+            if cache:
+                cached = cache.get_many(digests)
+                for i, d in enumerate(digests):
+                    doc.vectors[i] = cached.get(d)
+            todo = [i for i in range(len(doc.chunks)) if doc.vectors[i] is None]
+            STATS.count("embed_cache_hits", len(doc.chunks) - len(todo))
+            if not todo:
+                yield doc
+                continue
+            remaining[id(doc)] = len(todo)
+            for i in todo:
+                if digests[i] in followers:
+                    followers[digests[i]].append((doc, i))
+                    STATS.count("embed_shared_chunks")
+                    continue
+                followers[digests[i]] = []
+                tokens = estimate_tokens(doc.chunks[i])
+                if slots and (len(slots) >= batch_size or slot_tokens + tokens > batch_tokens):
+                    submit(slots)
+                    slots, slot_tokens = [], 0
+                    # Keep at most `concurrency` requests in flight; block for a free slot
+                    while len(pending) >= concurrency:
+                        yield from harvest(None)
+                slots.append((doc, i))
+                slot_tokens += tokens
+            yield from harvest(0)
+        if slots:
+            submit(slots)
+        while pending:
+            yield from harvest(None)
+
+def point_id(key: str, chunk_index: int) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{key}:{chunk_index}"))
+
+PAYLOAD_VERSION = 2  # bump when payload fields change; forces a rebuild like a chunker change
+
+def path_dirs(key: str) -> list[str]:
+    """Every ancestor folder of an object key: raw/a/b.md -> ["raw/", "raw/a/"] (keyword-indexed, for prefix filters)."""
+    parts = key.split("/")[:-1]
+    return ["/".join(parts[: i + 1]) + "/" for i in range(len(parts))]
+
+SPARSE_VECTOR = "text"  # named sparse vector next to the unnamed dense one
+SPARSE_VERSION = 1  # bump when lexical_tokens/sparse_vector change; forces a rebuild
+# Latin/digit identifiers with inner . - / : kept whole (kubectl, btc-usd, err_conn_refused, v1.2.3),
+# or a run of Hangul/Kana/CJK ideographs (split into bigrams: no spaces between Korean/Chinese words)
+TOKEN_RE = re.compile(r"[0-9a-z_]+(?:[.\-/:][0-9a-z_]+)*|[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+")
+BM25_K1, BM25_B, BM25_AVG_LEN = 1.2, 0.75, 100
+
+def lexical_tokens(text: str) -> list[str]:
+    """Terms for the sparse vector. The backend tokenizes queries the same way (keep both in sync)."""
+    out = []
+    for m in TOKEN_RE.finditer(text.lower()):
+        t = m.group()
+        if t[0] >= "\u3040":
+            out += [t[i : i + 2] for i in range(len(t) - 1)] or [t]
+            continue
+        out.append(t)
+        if not t.isalnum():
+            # Compound identifiers also match on their parts: "btc-usd" finds "btc"
+            out += [p for p in re.split(r"[.\-/:_]", t) if p]
+    return out
+
+def sparse_vector(text: str) -> qmodels.SparseVector:
+    """BM25 document side: saturated term frequency with length normalisation; Qdrant's IDF modifier adds idf at query time.
+
+    Terms are hashed (crc32) to indices, so no vocabulary has to be stored or shared.
+    """
+    tokens = lexical_tokens(text)
+    tf = defaultdict(int)
+    for t in tokens:
+        tf[zlib.crc32(t.encode())] += 1
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / BM25_AVG_LEN)
+    indices = sorted(tf)
+    return qmodels.SparseVector(indices=indices, values=[tf[i] * (BM25_K1 + 1) / (tf[i] + norm) for i in indices])
+
+def doc_points(doc: Doc, sparse: bool = False):
+    key = doc.key
+    base_id = hashlib.sha256(key.encode()).hexdigest()[:16]
+    dirs = path_dirs(key)
+    for i, vec, ctext, (start, end) in zip(doc.indices, doc.vectors, doc.chunks, doc.spans):
+        yield qmodels.PointStruct(
+            id=point_id(key, i),
+            vector={"": vec, SPARSE_VECTOR: sparse_vector(ctext)} if sparse else vec,
+            payload={
+                "doc_id": base_id,
+                "source": os.path.basename(key),
+                "path": key,
+                "dirs": dirs,
+                "chunk_index": i,
+                "text": ctext[:2000],
+                "char_start": start,
+                "char_end": end,
+                "created_at": doc.obj.last_modified.isoformat() if doc.obj.last_modified else "",
+            },
+        )
+
+def point_bytes(point) -> int:
+    """Rough request size of a point: float32 vector (+ sparse index/value pairs), chunk text and fixed payload overhead."""
+    vec = point.vector
+    if isinstance(vec, dict):
+        return sum(8 * len(v.indices) if isinstance(v, qmodels.SparseVector) else 4 * len(v) for v in vec.values()) \
+            + len(point.payload["text"].encode()) + 256
+    return 4 * len(vec) + len(point.payload["text"].encode()) + 256
+
+def upsert_docs(qdrant_client, docs, batch_size: int, on_doc=None, batch_bytes: int = 0,
+                concurrency: int = 1, wait_applied: bool = True, sparse: bool = False) -> int:
+    """Upsert points per doc.collection as docs arrive, up to concurrency batches in flight.
+
+    A batch is sent once it holds batch_size points or batch_bytes estimated bytes. With
+    wait_applied=False Qdrant answers once the batch is in its write-ahead log instead of after
+    indexing; the caller verifies the final count (wait_for_count). on_doc(doc) is called once
+    every point of the doc has been acknowledged, in submission order, so whatever it records
+    (manifest entries, checkpoints) never runs ahead of the collection.
+    """
+    batches = defaultdict(list)
+    sizes = defaultdict(int)
+    waiting = defaultdict(list)  # docs whose last point is in the open batch
+    inflight = deque()  # (future, collection, n points, docs completed by it), oldest first
+    total = 0
+
+    def send(collection, batch, size):
+        STATS.count("upsert_bytes", size)
+        with STATS.timed("upsert", len(batch)):
+            qdrant_client.upsert(collection_name=collection, points=batch, wait=wait_applied)
+
+    def harvest(limit):
+        nonlocal total
+        while len(inflight) > limit:
+            fut, collection, n, done = inflight.popleft()
+            fut.result()
+            STATS.count("points", n)
+            total += n
+            if n:
+                print(f"Upserted {n} points into {collection} (total so far: {total})")
+            for doc in done:
+                if on_doc:
+                    on_doc(doc)
+
+    def flush(collection, pool):
+        batch = batches.pop(collection, [])
+        size = sizes.pop(collection, 0)
+        fut = pool.submit(send, collection, batch, size) if batch else Future()
+        if not batch:
+            fut.set_result(None)
+        inflight.append((fut, collection, len(batch), waiting.pop(collection, [])))
+        harvest(concurrency - 1)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for doc in docs:
+            batch = batches[doc.collection]
+            for point in doc_points(doc, sparse):
+                batch.append(point)
+                sizes[doc.collection] += point_bytes(point)
+                if len(batch) >= batch_size or (batch_bytes and sizes[doc.collection] >= batch_bytes):
+                    flush(doc.collection, pool)
+                    batch = batches[doc.collection]
+            waiting[doc.collection].append(doc)
+            doc.chunks, doc.vectors = [], []
+        for collection in list(batches.keys() | waiting.keys()):
+            flush(collection, pool)
+        harvest(0)
+    return total
+
+def wait_for_count(qdrant_client, collection: str, expected: int, timeout: float) -> int:
+    """Exact point count of collection, polled until it equals expected or timeout seconds pass.
+
+    Upserts sent with wait=False are acknowledged before they are applied, so the count can lag briefly.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.2
+    while True:
+        count = qdrant_client.count(collection_name=collection, exact=True).count
+        if count == expected or time.monotonic() >= deadline:
+            return count
+        time.sleep(delay)
+        delay = min(delay * 2, 5.0)
+
+MANIFEST_VERSION = 1
+
+def object_fingerprint(obj) -> dict:
+    """ETag/size/last_modified of a listed MinIO object; any change means re-embed."""
+    return {
+        "etag": (obj.etag or "").strip('"'),
+        "size": obj.size,
+        "last_modified": obj.last_modified.isoformat() if obj.last_modified else "",
+    }
+
+def load_json(minio_client, bucket: str, key: str) -> dict | None:
+    """JSON state object from the bucket; None if it is missing or unreadable."""
+    try:
+        resp = minio_client.get_object(bucket, key)
+        try:
+            return json.loads(resp.read())
+        finally:
+            resp.close()
+            resp.release_conn()
+    except (S3Error, FileNotFoundError) as e:
+        if is_missing(e):
+            return None
+        raise
+    except ValueError as e:
+        print(f"{key} unreadable, ignoring: {e}", file=sys.stderr)
+        return None
+
+def save_json(minio_client, bucket: str, key: str, obj: dict) -> None:
+    data = json.dumps(obj, ensure_ascii=False, sort_keys=True).encode()
+    minio_client.put_object(bucket, key, BytesIO(data), len(data), content_type="application/json")
+
+def load_manifest(minio_client, bucket: str, key: str) -> dict | None:
+    manifest = load_json(minio_client, bucket, key)
+    if not manifest or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(minio_client, bucket: str, key: str, manifest: dict) -> None:
+    save_json(minio_client, bucket, key, manifest)
+
+def manifest_points(manifest: dict) -> int:
+    return sum(e.get("chunks", 0) for e in manifest.get("objects", {}).values())
+
+def versioned_name(collection: str) -> str:
+    return f"{collection}_v{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+
+def alias_target(qdrant_client, alias: str) -> str | None:
+    for a in qdrant_client.get_aliases().aliases:
+        if a.alias_name == alias:
+            return a.collection_name
+    return None
+
+QUANTIZATION = ("none", "scalar", "binary")
+
+def quantization_config(kind: str):
+    """Quantized copy of the vectors kept in RAM for search; originals are used for rescoring."""
+    if kind == "scalar":
+        # int8 per dimension: 4x smaller than float32
+        return qmodels.ScalarQuantization(
+            scalar=qmodels.ScalarQuantizationConfig(type=qmodels.ScalarType.INT8, quantile=0.99, always_ram=True)
+        )
+    if kind == "binary":
+        # 1 bit per dimension: 32x smaller; needs rescoring with oversampling to keep recall
+        return qmodels.BinaryQuantization(binary=qmodels.BinaryQuantizationConfig(always_ram=True))
+    return None
+
+def create_collection(qdrant_client, collection: str, dim: int, storage: dict, sparse: bool = False) -> None:
     qdrant_client.create_collection(
         collection_name=collection,
-        vectors_config=qmodels.VectorParams(size=1536, distance=qmodels.Distance.COSINE),
+        vectors_config=qmodels.VectorParams(size=dim, distance=qmodels.Distance.COSINE, on_disk=storage["on_disk"]),
+        # IDF is computed by Qdrant from the live collection, so it stays right as documents come and go
+        sparse_vectors_config={SPARSE_VECTOR: qmodels.SparseVectorParams(modifier=qmodels.Modifier.IDF)} if sparse else None,
+        on_disk_payload=storage["on_disk_payload"],
+        hnsw_config=qmodels.HnswConfigDiff(m=storage["hnsw_m"], ef_construct=storage["hnsw_ef_construct"]),
+        quantization_config=quantization_config(storage["quantization"]),
+    )
+    # Indexes created before the first upsert are built incrementally instead of by a full re-scan
+    ensure_payload_indexes(qdrant_client, collection)
+    print(f"Created collection {collection} ({', '.join(f'{k}={v}' for k, v in storage.items())}).")
+
+PAYLOAD_INDEXES = {
+    "doc_id": qmodels.PayloadSchemaType.KEYWORD,
+    "path": qmodels.PayloadSchemaType.KEYWORD,
+    "dirs": qmodels.PayloadSchemaType.KEYWORD,
+    "source": qmodels.PayloadSchemaType.KEYWORD,
+    "chunk_index": qmodels.PayloadSchemaType.INTEGER,
+}
+
+def ensure_payload_indexes(qdrant_client, collection: str) -> None:
+    """Index the fields that deletes and search filters use, so they are lookups instead of full scans."""
+    schema = qdrant_client.get_collection(collection_name=collection).payload_schema or {}
+    missing = [name for name in PAYLOAD_INDEXES if name not in schema]
+    for name in missing:
+        qdrant_client.create_payload_index(collection_name=collection, field_name=name, field_schema=PAYLOAD_INDEXES[name])
+    if missing:
+        print(f"Created payload indexes on {collection}: {', '.join(missing)}")
+
+def update_storage(qdrant_client, collection: str, storage: dict) -> None:
+    """Apply changed storage settings to an existing version in place (Qdrant re-optimizes in the background)."""
+    qdrant_client.update_collection(
+        collection_name=collection,
+        vectors_config={"": qmodels.VectorParamsDiff(on_disk=storage["on_disk"])},
+        collection_params=qmodels.CollectionParamsDiff(on_disk_payload=storage["on_disk_payload"]),
+        hnsw_config=qmodels.HnswConfigDiff(m=storage["hnsw_m"], ef_construct=storage["hnsw_ef_construct"]),
+        quantization_config=quantization_config(storage["quantization"]) or qmodels.Disabled.DISABLED,
+    )
+    print(f"Updated storage of {collection} ({', '.join(f'{k}={v}' for k, v in storage.items())}).")
+
+def swap_alias(qdrant_client, alias: str, collection: str) -> None:
+    """Atomically point alias at collection (blue/green switch; queries never see a partial build)."""
+    ops = []
+    if alias_target(qdrant_client, alias):
+        ops.append(qmodels.DeleteAliasOperation(delete_alias=qmodels.DeleteAlias(alias_name=alias)))
+    elif qdrant_client.collection_exists(alias):
+        # One-time migration: a plain collection still owns the name the alias needs
+        qdrant_client.delete_collection(collection_name=alias)
+        print(f"Deleted legacy collection {alias} (replaced by alias).")
+    ops.append(qmodels.CreateAliasOperation(create_alias=qmodels.CreateAlias(collection_name=collection, alias_name=alias)))
+    qdrant_client.update_collection_aliases(change_aliases_operations=ops)
+    print(f"Alias {alias} -> {collection}.")
+
+def mark_revision(qdrant_client, alias: str, collection: str) -> None:
+    """Replace the {alias}__rev_<run id> alias on collection with a fresh one.
+
+    Backends key cached answers on it: an in-place update that keeps the point count still
+    changes the revision.
+    """
+    marker = f"{alias}__rev_"
+    ops = [qmodels.DeleteAliasOperation(delete_alias=qmodels.DeleteAlias(alias_name=a.alias_name))
+           for a in qdrant_client.get_aliases().aliases if a.alias_name.startswith(marker)]
+    ops.append(qmodels.CreateAliasOperation(create_alias=qmodels.CreateAlias(
+        collection_name=collection, alias_name=f"{marker}{uuid.uuid4().hex[:12]}")))
+    qdrant_client.update_collection_aliases(change_aliases_operations=ops)
+
+def gc_versions(qdrant_client, alias: str, retention_hours: float) -> None:
+    """Delete {alias}_v<ts> collections older than the retention window, except the alias target."""
+    live = alias_target(qdrant_client, alias)
+    cutoff = time.strftime("%Y%m%d%H%M%S", time.gmtime(time.time() - retention_hours * 3600))
+    pattern = re.compile(rf"^{re.escape(alias)}_v(\d{{14}})$")
+    for c in qdrant_client.get_collections().collections:
+        m = pattern.match(c.name)
+        if m and c.name != live and m.group(1) < cutoff:
+            qdrant_client.delete_collection(collection_name=c.name)
+            print(f"Deleted old version {c.name}.")
+
+def delete_paths(qdrant_client, collection: str, paths: list[str], batch_size: int = 100) -> None:
+    """Remove every point whose payload path is in paths (one filtered delete per batch)."""
+    for i in range(0, len(paths), batch_size):
+        qdrant_client.delete(
+            collection_name=collection,
+            points_selector=qmodels.FilterSelector(
+                filter=qmodels.Filter(
+                    must=[qmodels.FieldCondition(key="path", match=qmodels.MatchAny(any=paths[i : i + batch_size]))]
+                )
+            ),
+        )
+
+def path_filter(value: str) -> qmodels.Filter:
+    """Points of one object key, or of everything below a folder when value ends with '/'."""
+    key = "dirs" if value.endswith("/") else "path"
+    return qmodels.Filter(must=[qmodels.FieldCondition(key=key, match=qmodels.MatchValue(value=value))])
+
+def delete_stale_chunks(qdrant_client, collection: str, path: str, kept: list[int]) -> None:
+    """Remove points of path whose chunk_index is not in kept (document got shorter or chunks deduped)."""
+    qdrant_client.delete(
+        collection_name=collection,
+        points_selector=qmodels.FilterSelector(
+            filter=qmodels.Filter(
+                must=[qmodels.FieldCondition(key="path", match=qmodels.MatchValue(value=path))],
+                must_not=[qmodels.FieldCondition(key="chunk_index", match=qmodels.MatchAny(any=kept))] if kept else [],
+            )
+        ),
     )
-    print(f"Created collection {collection}.")
 
-    objects = list(minio_client.list_objects(bucket, prefix=prefix, recursive=True))
+@dataclass
+class Route:
+    """One prefix -> collection alias and that collection's state in this run."""
+    prefix: str
+    collection: str
+    manifest_key: str
+    checkpoint_key: str = ""
+    target: str | None = None  # version the alias pointed at when the run started
+    build: str | None = None  # fresh version of a full build, swapped in at the end
+    resumed: bool = False  # continuing an interrupted run from its checkpoint
+    previous: dict = field(default_factory=dict)  # manifest objects of the last run
+    current: dict = field(default_factory=dict)  # path -> fingerprint as listed now
+    entries: dict = field(default_factory=dict)  # manifest objects written at the end
+    changed: list = field(default_factory=list)
+    done: set = field(default_factory=set)  # objects whose points are all upserted in this run
+    duplicates: dict = field(default_factory=dict)  # (kept path, chunk_index) -> paths of dropped copies
+    checkpointed_at: float = 0.0
+
+    @property
+    def work(self) -> str:
+        return self.build or self.target
+
+CHECKPOINT_VERSION = 1
+
+def save_checkpoint(minio_client, bucket: str, route: Route, config: dict) -> None:
+    """Persist progress of an unfinished run: the version being written and every object already in it."""
+    save_json(minio_client, bucket, route.checkpoint_key, {
+        "version": CHECKPOINT_VERSION,
+        "collection": route.collection,
+        "target": route.target,
+        "build": route.build,
+        "config": config,
+        "saved_at": datetime.now(timezone.utc).isoformat(),
+        "objects": route.entries,
+        "done": sorted(route.done),
+        "duplicates": [[key, idx, sorted(paths)] for (key, idx), paths in route.duplicates.items()],
+    })
+    route.checkpointed_at = time.monotonic()
+
+def load_checkpoint(qdrant_client, minio_client, bucket: str, route: Route, mode: str, config: dict,
+                    max_age_hours: float) -> dict | None:
+    """Checkpoint of an interrupted run that can still be continued, else None."""
+    cp = load_json(minio_client, bucket, route.checkpoint_key)
+    if not cp or cp.get("version") != CHECKPOINT_VERSION:
+        return None
+    saved_at = datetime.fromisoformat(cp["saved_at"])
+    reason = None
+    if cp.get("config") != config:
+        reason = "config changed"
+    elif cp.get("target") != route.target:
+        reason = f"alias moved to {route.target}"
+    elif (datetime.now(timezone.utc) - saved_at).total_seconds() > max_age_hours * 3600:
+        reason = f"older than {max_age_hours:g}h"
+    elif not cp.get("build") and mode == "full":
+        reason = "full run requested"
+    elif not qdrant_client.collection_exists(cp.get("build") or route.target or ""):
+        reason = "collection is gone"
+    if reason:
+        print(f"{route.collection}: ignoring checkpoint from {cp['saved_at']} ({reason}).")
+        return None
+    return cp
+
+def clear_checkpoint(minio_client, bucket: str, route: Route) -> None:
+    if route.checkpoint_key:
+        minio_client.remove_object(bucket, route.checkpoint_key)
+
+def parse_routes(spec: str) -> dict:
+    """INGEST_ROUTES "raw/a/=rag_docs_a,raw/b/=rag_docs_b" -> {prefix: collection}."""
+    routes = {}
+    for part in spec.split(","):
+        prefix, sep, collection = (s.strip() for s in part.partition("="))
+        if not sep or not prefix or not collection:
+            print(f"INGEST_ROUTES entry must be <prefix>=<collection>, got: {part!r}", file=sys.stderr)
+            sys.exit(1)
+        routes[prefix.rstrip("/") + "/"] = collection
+    if len(set(routes.values())) != len(routes):
+        print(f"INGEST_ROUTES maps several prefixes to one collection: {spec}", file=sys.stderr)
+        sys.exit(1)
+    return routes
+
+def auto_routes(objects, prefix: str, collection: str) -> dict:
+    """{prefix}{system_id}/ -> {collection}_{system_id} for every system_id present in the listing."""
+    ids = {o.object_name[len(prefix) :].split("/", 1)[0] for o in objects if "/" in o.object_name[len(prefix) :]}
+    return {f"{prefix}{sid}/": f"{collection}_{sid}" for sid in sorted(ids)}
+
+def route_of(key: str, routes: list[Route]) -> Route | None:
+    """Route with the longest prefix of key (raw/a/b/ wins over raw/a/)."""
+    return max((r for r in routes if key.startswith(r.prefix)), key=lambda r: len(r.prefix), default=None)
+
+def prepare_route(qdrant_client, minio_client, bucket: str, route: Route, objects, mode: str, config: dict,
+                  storage: dict, checkpoint_max_age_hours: float) -> None:
+    """Resolve the alias, validate the manifest (or resume a checkpoint), start a build if needed and work out the delta."""
+    collection = route.collection
+    # QDRANT_COLLECTION is an alias; data lives in {collection}_v<timestamp> versions behind it
+    route.target = alias_target(qdrant_client, collection)
+    manifest = None
+    cp = None
+    if route.checkpoint_key:
+        cp = load_checkpoint(qdrant_client, minio_client, bucket, route, mode, config, checkpoint_max_age_hours)
+    if cp:
+        # Objects the interrupted run finished count as unchanged; the version it was writing is reused.
+        # Its unacknowledged batches are simply redone: point ids are deterministic.
+        manifest, route.build, route.resumed = cp, cp.get("build"), True
+        route.done = set(cp.get("done", []))
+        route.duplicates = {(key, idx): set(paths) for key, idx, paths in cp.get("duplicates", [])}
+        print(f"{collection}: resuming run from checkpoint {cp['saved_at']} "
+              f"({len(route.done)} objects done, writing {route.build or route.target}).")
+    elif mode == "incremental":
+        manifest = load_manifest(minio_client, bucket, route.manifest_key)
+        if manifest and manifest.get("config") != config:
+            print(f"{collection}: chunking/embedding config changed since last run; re-indexing everything.")
+            manifest = None
+        if manifest and (not route.target or manifest.get("target") != route.target):
+            print(f"Alias {collection} -> {route.target}, manifest built for {manifest.get('target')}; re-indexing everything.")
+            manifest = None
+        if manifest:
+            points_count = qdrant_client.count(collection_name=route.target, exact=True).count
+            if points_count != manifest_points(manifest):
+                print(f"{route.target} has {points_count} points, manifest expects {manifest_points(manifest)}; re-indexing everything.")
+                manifest = None
+    if manifest is None:
+        # Full build into a fresh version; the live alias keeps serving the old one until the swap
+        route.build = versioned_name(collection)
+        while qdrant_client.collection_exists(route.build):
+            # Names have 1s resolution; never build into the version that is live
+            time.sleep(1)
+            route.build = versioned_name(collection)
+        create_collection(qdrant_client, route.build, config["dim"], storage, sparse=config["sparse"] != "off")
+    else:
+        if not route.build and manifest.get("storage") != storage:
+            # Quantization/on-disk/HNSW do not change vectors, so the live version is converted, not rebuilt
+            update_storage(qdrant_client, route.target, storage)
+        ensure_payload_indexes(qdrant_client, route.work)
+    previous = route.previous = (manifest or {}).get("objects", {})
+
+    current = route.current = {o.object_name: object_fingerprint(o) for o in objects}
+    changed = [o for o in objects if previous.get(o.object_name, {}).get("fingerprint") != current[o.object_name]]
+    removed = [k for k in previous if k not in current]
+    # Objects that shared deduplicated chunks with a changed/removed one are re-processed with it
+    dirty = {o.object_name for o in changed} | set(removed)
+    frontier = set(dirty)
+    while frontier:
+        linked = {k for k in current if k not in dirty and frontier & set(previous.get(k, {}).get("linked", []))}
+        dirty |= linked
+        frontier = linked
+    route.changed = [o for o in objects if o.object_name in dirty]
+    print(f"Objects {collection}: {len(objects)} listed, {len(route.changed)} new/changed, {len(removed)} removed, "
+          f"{len(objects) - len(route.changed)} unchanged.")
     if not objects:
-        print(f"No objects under {bucket}/{prefix}. Collection is empty. Upload PDF/txt then re-run.")
-        sys.exit(0)
+        print(f"No objects under {bucket}/{route.prefix}. Collection is empty. Upload PDF/txt then re-run.")
 
-    points_to_upsert = []
-    for obj in objects:
-        key = obj.object_name
-        if key.endswith("/"):
+    if removed:
+        delete_paths(qdrant_client, route.work, removed)
+        print(f"Deleted points of {len(removed)} removed objects from {route.work}.")
+    # Changed objects keep their old entry (and vectors) until re-embedded, so a failed
+    # embedding leaves the previous version searchable and is retried next run
+    route.entries = {k: v for k, v in previous.items() if k in current}
+
+def finish_route(qdrant_client, minio_client, bucket: str, route: Route, config: dict, storage: dict,
+                 retention_hours: float, settle_seconds: float = 0.0, text_cache: TextCache | None = None) -> bool:
+    """Link duplicates, verify, swap the alias, save the manifest and drop extracted text of PDFs gone since the last
+    one; False if a build was discarded."""
+    collection, work, entries, duplicates = route.collection, route.work, route.entries, route.duplicates
+    if duplicates:
+        set_duplicate_paths(qdrant_client, work, {o: p for o, p in duplicates.items() if o[0] in route.done})
+        for (owner, _), paths in duplicates.items():
+            for p in paths - {owner}:
+                if p not in entries:
+                    continue
+                if owner not in route.done:
+                    # The kept copy was never stored; force the dropped copy to be re-processed next run
+                    entries[p]["fingerprint"] = {}
+                    continue
+                entries[owner].setdefault("linked", [])
+                entries[p].setdefault("linked", [])
+                entries[owner]["linked"] = sorted(set(entries[owner]["linked"]) | {p})
+                entries[p]["linked"] = sorted(set(entries[p]["linked"]) | {owner})
+        print(f"Near-duplicates in {collection}: {sum(len(p) for p in duplicates.values())} chunk copies "
+              f"merged into {len(duplicates)} chunks.")
+
+    expected = sum(e["chunks"] for e in entries.values())
+    points_count = wait_for_count(qdrant_client, work, expected, settle_seconds)
+    if points_count != expected:
+        print(f"{work} has {points_count} points, expected {expected}.", file=sys.stderr)
+        if route.build:
+            qdrant_client.delete_collection(collection_name=route.build)
+            clear_checkpoint(minio_client, bucket, route)
+            print(f"Alias {collection} left on {route.target}; deleted incomplete {route.build}.", file=sys.stderr)
+            return False
+    if route.build:
+        swap_alias(qdrant_client, collection, route.build)
+        gc_versions(qdrant_client, collection, retention_hours)
+    if route.build or route.done or route.previous.keys() - route.current.keys():
+        mark_revision(qdrant_client, collection, work)
+
+    # route.previous is empty for full builds, so compare with the manifest being replaced
+    replaced = (load_manifest(minio_client, bucket, route.manifest_key) or {}).get("objects", {}) if text_cache else {}
+    save_manifest(minio_client, bucket, route.manifest_key, {
+        "version": MANIFEST_VERSION,
+        "collection": collection,
+        "target": work,
+        "config": config,
+        "storage": storage,
+        "objects": entries,
+    })
+    clear_checkpoint(minio_client, bucket, route)
+    if text_cache:
+        text_cache.discard(pdf_etags(replaced) - {f["etag"] for k, f in route.current.items() if k.lower().endswith(".pdf")})
+    print(f"Done. {collection} -> {work} points_count={points_count}")
+    return True
+
+REPORT_VERSION = 1
+
+def run_report(collection: str, mode: str, routes: list, status: str, started: float, error: str = "") -> dict:
+    """Machine-readable summary of one run: per-route object counts, stage latencies and counters."""
+    return {
+        "version": REPORT_VERSION,
+        "collection": collection,
+        "mode": mode,
+        "status": status,
+        "error": error,
+        "started_at": datetime.fromtimestamp(started, timezone.utc).isoformat(),
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "wall_s": round(time.time() - started, 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "routes": [{
+            "collection": r.collection,
+            "target": r.work,
+            "full_build": bool(r.build),
+            "resumed": r.resumed,
+            "objects": len(r.current),
+            "changed": len(r.changed),
+            "done": len(r.done),
+            "removed": len(r.previous.keys() - r.current.keys()) if not r.build else 0,
+            "chunks": sum(e["chunks"] for e in r.entries.values()),
+        } for r in routes],
+        **STATS.report(),
+    }
+
+def publish_report(minio_client, bucket: str, report: dict, target: str, key: str, pushgateway: str, job: str) -> None:
+    """Write report to stdout or MinIO key and push its metrics to a Prometheus pushgateway. Failures only warn."""
+    if target == "stdout":
+        print("Run report: " + json.dumps(report, ensure_ascii=False, sort_keys=True))
+    elif target == "minio":
+        try:
+            save_json(minio_client, bucket, key, report)
+            print(f"Run report saved to {bucket}/{key}")
+        except Exception as e:
+            print(f"Run report upload failed: {e}", file=sys.stderr)
+    if not pushgateway:
+        return
+    labels = f'collection="{report["collection"]}",mode="{report["mode"]}"'
+    body = STATS.prometheus(labels)
+    body += "# TYPE rag_ingest_wall_seconds gauge\n" + f'rag_ingest_wall_seconds{{{labels}}} {report["wall_s"]}\n'
+    body += "# TYPE rag_ingest_peak_rss_bytes gauge\n" + f'rag_ingest_peak_rss_bytes{{{labels}}} {report["peak_rss_mb"] * 1e6:.0f}\n'
+    body += "# TYPE rag_ingest_success gauge\n" + f'rag_ingest_success{{{labels}}} {int(report["status"] == "ok")}\n'
+    if report["status"] == "ok":
+        # POST (not PUT) keeps this from the last good run while later runs fail
+        body += "# TYPE rag_ingest_last_success_timestamp_seconds gauge\n"
+        body += f'rag_ingest_last_success_timestamp_seconds{{{labels}}} {time.time():.0f}\n'
+    url = f"{pushgateway.rstrip('/')}/metrics/job/{job}/collection/{report['collection']}"
+    try:
+        req = urllib.request.Request(url, data=body.encode(), method="POST",
+                                     headers={"Content-Type": "text/plain; version=0.0.4"})
+        urllib.request.urlopen(req, timeout=10).close()
+        print(f"Metrics pushed to {url}")
+    except Exception as e:
+        print(f"Metrics push failed: {e}", file=sys.stderr)
+
+_CLIENTS = {}  # settings -> client, reused by every run of a long-lived process (watch)
+
+def minio_from_env():
+    source_dir = get_env("SOURCE_DIR")
+    if source_dir:
+        return _CLIENTS.setdefault(("dir", source_dir), LocalObjectStore(source_dir))
+    endpoint = f"{get_env('MINIO_ENDPOINT', 'minio.devops.svc.cluster.local')}:{int(get_env('MINIO_PORT', '9000'))}"
+    access_key, secret_key = require_env("MINIO_ACCESS_KEY"), require_env("MINIO_SECRET_KEY")
+    secure = get_env("MINIO_USE_SSL", "false").lower() == "true"
+    # One pooled connection per fetch thread plus the cache/manifest/checkpoint calls beside them;
+    # otherwise as Minio's default client
+    pool_size = max(10, int(get_env("FETCH_WORKERS", "4")) + 4)
+    key = ("minio", endpoint, access_key, secure, pool_size)
+    if key not in _CLIENTS:
+        http_client = urllib3.PoolManager(
+            timeout=urllib3.Timeout(connect=300, read=300),
+            maxsize=pool_size,
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+            retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+        )
+        _CLIENTS[key] = Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=secure, http_client=http_client)
+    return _CLIENTS[key]
+
+def qdrant_from_env() -> QdrantClient:
+    location = get_env("QDRANT_LOCATION")
+    host, port = get_env("QDRANT_HOST", "qdrant"), int(get_env("QDRANT_PORT", "6333"))
+    # gRPC sends vectors as packed floats instead of JSON text: smaller and cheaper to encode
+    prefer_grpc = get_env("QDRANT_PREFER_GRPC", "false").lower() == "true"
+    grpc_port = int(get_env("QDRANT_GRPC_PORT", "6334"))
+    key = ("qdrant", location, host, port, prefer_grpc, grpc_port)
+    if key not in _CLIENTS:
+        if location:
+            _CLIENTS[key] = QdrantClient(location=location)
+        else:
+            _CLIENTS[key] = QdrantClient(host=host, port=port, grpc_port=grpc_port, prefer_grpc=prefer_grpc,
+                                         check_compatibility=False)
+    return _CLIENTS[key]
+
+def delete_command(command: str, values: list[str]) -> None:
+    """delete-path <key>... / delete-prefix <folder/>...: drop those objects' points, manifest and extracted-text entries.
+
+    One filtered delete per argument (path / dirs are keyword-indexed) on the live version the
+    alias points to. The manifest is updated so the next incremental run stays incremental;
+    objects still in MinIO are re-indexed by it, so delete them there too.
+    """
+    if not values:
+        print(f"Usage: ingest.py {command} <{'key' if command == 'delete-path' else 'prefix/'}>...", file=sys.stderr)
+        sys.exit(1)
+    if command == "delete-prefix":
+        values = [v.rstrip("/") + "/" for v in values]
+    minio_client = minio_from_env()
+    qdrant_client = qdrant_from_env()
+    bucket = get_env("MINIO_BUCKET", "rag-docs")
+    prefix = get_env("MINIO_PREFIX", "raw/").rstrip("/") + "/"
+    collection = get_env("QDRANT_COLLECTION", "rag_docs")
+    route_spec = get_env("INGEST_ROUTES")
+    text_cache = text_cache_from_env(minio_client, bucket)
+    if not route_spec:
+        routes = [Route(prefix, collection, get_env("MANIFEST_KEY", f"manifests/{collection}.json"))]
+    else:
+        if route_spec.lower() == "auto":
+            route_map = auto_routes([SimpleNamespace(object_name=v) for v in values], prefix, collection)
+        else:
+            route_map = parse_routes(route_spec)
+        routes = [Route(p, c, f"manifests/{c}.json") for p, c in route_map.items()]
+
+    for value in values:
+        route = route_of(value, routes)
+        if route is None:
+            print(f"{value}: matches no route in INGEST_ROUTES, skipped.", file=sys.stderr)
             continue
-        data = minio_client.get_object(bucket, key).read()
-        text = extract_text(data, key)
-        if not text.strip():
+        work = alias_target(qdrant_client, route.collection) or route.collection
+        selector = path_filter(value)
+        count = qdrant_client.count(collection_name=work, count_filter=selector, exact=True).count
+        qdrant_client.delete(collection_name=work, points_selector=qmodels.FilterSelector(filter=selector), wait=True)
+        if count:
+            mark_revision(qdrant_client, route.collection, work)
+        manifest = load_manifest(minio_client, bucket, route.manifest_key)
+        dropped = 0
+        if manifest and manifest.get("target") == work:
+            objects = manifest["objects"]
+            gone = {k: objects.pop(k) for k in list(objects) if (k.startswith(value) if value.endswith("/") else k == value)}
+            dropped = len(gone)
+            save_manifest(minio_client, bucket, route.manifest_key, manifest)
+            if text_cache:
+                text_cache.discard(pdf_etags(gone) - pdf_etags(objects))
+        print(f"{value}: deleted {count} points from {work}, {dropped} manifest entries.")
+
+class RunContext:
+    """What outlives a single run: embedding provider, clients, worker pools and the embedding cache.
+
+    main() opens one per run; watch keeps one for the life of the process, so a pass neither
+    re-downloads the cache nor restarts the extract workers.
+    """
+
+    def __init__(self, cache_sync_seconds: float = 0.0):
+        try:
+            self.embedder = provider_from_env()
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        self.minio_client = minio_from_env()
+        self.qdrant_client = qdrant_from_env()
+        self.bucket = get_env("MINIO_BUCKET", "rag-docs")
+        self.text_cache = text_cache_from_env(self.minio_client, self.bucket)
+        self.fetch_workers = max(1, int(get_env("FETCH_WORKERS", "4")))
+        self.extract_workers = int(get_env("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.use_cache = get_env("EMBED_CACHE", "true").lower() == "true"
+        collection = get_env("QDRANT_COLLECTION", "rag_docs")
+        # Vectors are content-addressed, so routed runs share one cache across their collections
+        self.cache_key = get_env("EMBED_CACHE_KEY", "cache/embeddings-shared.sqlite" if get_env("INGEST_ROUTES")
+                                 else f"cache/embeddings-{collection}.sqlite")
+        self.cache_path = get_env("EMBED_CACHE_PATH", "/tmp/embed-cache.sqlite")
+        self.cache_max_age_days = int(get_env("EMBED_CACHE_MAX_AGE_DAYS", "30"))
+        # 0 uploads after every run; watch batches uploads of many small passes
+        self.cache_sync_seconds = cache_sync_seconds
+        self.cache = None
+        self.cache_uploaded_at = time.monotonic()
+        self.fetch_pool = ThreadPoolExecutor(max_workers=self.fetch_workers)
+        self.extract_pool = None
+        self.start_extract_pool()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start_extract_pool(self) -> None:
+        """(Re)start the PDF extract processes; also after a killed worker broke the pool."""
+        if self.extract_pool:
+            self.extract_pool.shutdown(wait=False, cancel_futures=True)
+            self.extract_pool = None
+        if self.extract_workers > 0:
+            # Not fork: fetch threads and connection pools are already running, and a forked child can
+            # inherit a lock some other thread held at that moment
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.extract_pool = ProcessPoolExecutor(max_workers=self.extract_workers,
+                                                    mp_context=multiprocessing.get_context(method))
+
+    def embedding_cache(self) -> EmbeddingCache | None:
+        """The embedding cache, downloaded on first use; None with EMBED_CACHE=false."""
+        if self.use_cache and self.cache is None:
+            e = self.embedder
+            self.cache = load_embedding_cache(self.minio_client, self.bucket, self.cache_key, self.cache_path,
+                                              e.name, e.model, e.dim)
+        return self.cache
+
+    def save_cache(self, prune: bool = False) -> None:
+        """End of a run: prune if allowed, upload if cache_sync_seconds have passed since the last upload."""
+        if not self.cache:
+            return
+        upload = time.monotonic() - self.cache_uploaded_at >= self.cache_sync_seconds
+        save_embedding_cache(self.cache, self.minio_client, self.bucket, self.cache_key, self.cache_path,
+                             self.cache_max_age_days, prune, upload)
+        if upload:
+            self.cache_uploaded_at = time.monotonic()
+
+    def close(self) -> None:
+        self.fetch_pool.shutdown(cancel_futures=True)
+        if self.extract_pool:
+            self.extract_pool.shutdown(cancel_futures=True)
+        if self.cache:
+            upload_embedding_cache(self.cache, self.minio_client, self.bucket, self.cache_key, self.cache_path)
+            self.cache.close()
+            self.cache = None
+
+class EventInbox:
+    """Object keys reported by notifications, held until their burst has settled."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.keys = set()
+        self.first = self.last = 0.0
+
+    def add(self, keys) -> None:
+        keys = set(keys)
+        if not keys:
+            return
+        with self.cond:
+            now = time.monotonic()
+            if not self.keys:
+                self.first = now
+            self.keys |= keys
+            self.last = now
+            self.cond.notify()
+
+    def take(self, debounce: float, max_delay: float, timeout: float) -> set[str]:
+        """Wait up to timeout for a burst that has been quiet for debounce seconds (or started max_delay ago)."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.keys and (now - self.last >= debounce or now - self.first >= max_delay):
+                    keys, self.keys = self.keys, set()
+                    return keys
+                if now >= deadline:
+                    return set()
+                wake = deadline
+                if self.keys:
+                    wake = min(wake, self.last + debounce, self.first + max_delay)
+                self.cond.wait(max(wake - now, 0.05))
+
+def event_keys(body: dict, bucket: str) -> list[str]:
+    """Object keys of s3:ObjectCreated:* / s3:ObjectRemoved:* records in a MinIO webhook payload."""
+    keys = []
+    for rec in body.get("Records") or []:
+        s3 = rec.get("s3") or {}
+        if not rec.get("eventName", "").startswith(("s3:ObjectCreated:", "s3:ObjectRemoved:")):
             continue
-        chunks = chunk_text(text, size=chunk_size, overlap=chunk_overlap)
-        if not chunks:
+        if (s3.get("bucket") or {}).get("name") != bucket:
             continue
+        keys.append(unquote_plus((s3.get("object") or {}).get("key", "")))
+    return [k for k in keys if k and not k.endswith("/")]
+
+def serve_webhook(inbox: EventInbox, bucket: str, port: int, token: str) -> ThreadingHTTPServer:
+    """POST /events (MinIO notify_webhook target) feeds the inbox; GET /health for probes."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200 if self.path == "/health" else 404)
+            self.end_headers()
+
+        def do_POST(self):
+            auth = self.headers.get("Authorization", "")
+            if token and auth not in (token, f"Bearer {token}"):
+                self.send_response(401)
+                self.end_headers()
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            inbox.add(event_keys(body, bucket))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def poll_changes(minio_client, bucket: str, prefix: str, interval: float, inbox: EventInbox) -> None:
+    """Stand-in for notifications (local testing, no webhook): diff listings every interval seconds."""
+    def snapshot():
+        return {o.object_name: object_fingerprint(o) for o in minio_client.list_objects(bucket, prefix=prefix, recursive=True)
+                if not o.object_name.endswith("/")}
+
+    seen = None  # the first listing is retried like the others, so MinIO being down at startup does not end polling
+    while True:
         try:
-            vectors_ordered = embed_fn(chunks)
+            now = snapshot()
         except Exception as e:
-            print(f"Embedding error for {key}: {e}", file=sys.stderr)
+            print(f"Watch: listing failed: {e}", file=sys.stderr)
+            time.sleep(interval)
             continue
+        if seen is not None:
+            inbox.add([k for k in now.keys() | seen.keys() if now.get(k) != seen.get(k)])
+        seen = now
+        time.sleep(interval)
 
-        base_id = hashlib.sha256(key.encode()).hexdigest()[:16]
-        for i, (vec, ctext) in enumerate(zip(vectors_ordered, chunks)):
-            point_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{key}:{i}"))
-            points_to_upsert.append(
-                qmodels.PointStruct(
-                    id=point_id,
-                    vector=vec,
-                    payload={
-                        "doc_id": base_id,
-                        "source": os.path.basename(key),
-                        "path": key,
-                        "chunk_index": i,
-                        "text": ctext[:2000],
-                        "created_at": obj.last_modified.isoformat() if obj.last_modified else "",
-                    },
-                )
-            )
-        print(f"  {key}: {len(chunks)} chunks")
+def watch_command() -> None:
+    """Long-running worker: incremental runs limited to the collections of changed objects, seconds after the change.
 
-    if not points_to_upsert:
-        print("No points to upsert.")
-        sys.exit(0)
+    A startup run and one every WATCH_RESYNC_SECONDS cover notifications missed while the worker was down.
+    All passes share one RunContext; the embedding cache is uploaded at most every WATCH_CACHE_SYNC_SECONDS
+    and on shutdown.
+    """
+    source = get_env("WATCH_SOURCE", "webhook").lower()
+    if source not in ("webhook", "poll"):
+        print(f"WATCH_SOURCE must be webhook or poll, got: {source}", file=sys.stderr)
+        sys.exit(1)
+    debounce = float(get_env("WATCH_DEBOUNCE_SECONDS", "5"))
+    max_delay = float(get_env("WATCH_MAX_DELAY_SECONDS", "60"))
+    resync = float(get_env("WATCH_RESYNC_SECONDS", "3600"))
+    bucket = get_env("MINIO_BUCKET", "rag-docs")
+    prefix = get_env("MINIO_PREFIX", "raw/").rstrip("/") + "/"
+    ctx = RunContext(cache_sync_seconds=float(get_env("WATCH_CACHE_SYNC_SECONDS", "600")))
+    inbox = EventInbox()
+    # Served in poll mode too: the readiness probe checks /health
+    port = int(get_env("WATCH_PORT", "8080"))
+    serve_webhook(inbox, bucket, port, get_env("WATCH_AUTH_TOKEN"))
+    if source == "webhook":
+        print(f"Watch: listening for MinIO events on :{port}/events")
+    else:
+        interval = float(get_env("WATCH_POLL_SECONDS", "10"))
+        threading.Thread(target=poll_changes, args=(ctx.minio_client, bucket, prefix, interval, inbox), daemon=True).start()
+        print(f"Watch: polling {bucket}/{prefix} every {interval:g}s")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
 
-    batch_size = 100
-    for i in range(0, len(points_to_upsert), batch_size):
-        batch = points_to_upsert[i : i + batch_size]
-        qdrant_client.upsert(collection_name=collection, points=batch)
-        print(f"Upserted {len(batch)} points (total so far: {min(i + batch_size, len(points_to_upsert))})")
+    with ctx:
+        watch_loop(ctx, inbox, debounce, max_delay, resync)
 
-    info = qdrant_client.get_collection(collection)
-    print(f"Done. {collection} points_count={info.points_count}")
+def watch_loop(ctx: RunContext, inbox: EventInbox, debounce: float, max_delay: float, resync: float) -> None:
+    keys, backoff, next_resync = None, 0.0, 0.0
+    while True:
+        if keys is None and time.monotonic() < next_resync:
+            keys = inbox.take(debounce, max_delay, timeout=next_resync - time.monotonic()) or None
+            if keys is not None:
+                print(f"Watch: {len(keys)} changed objects: {', '.join(sorted(keys)[:5])}{' ...' if len(keys) > 5 else ''}")
+        if keys is None:
+            next_resync = time.monotonic() + resync
+        STATS.reset()
+        try:
+            run_once(ctx, mode="incremental", keys=keys)
+            keys, backoff = None, 0.0
+        except SystemExit as e:
+            if e.code == 128 + signal.SIGTERM:
+                raise
+            backoff = min(max(backoff * 2, 5.0), 300.0)
+        except Exception as e:
+            print(f"Watch: run failed: {e}", file=sys.stderr)
+            if isinstance(e, BrokenProcessPool):
+                ctx.start_extract_pool()
+            backoff = min(max(backoff * 2, 5.0), 300.0)
+        if backoff:
+            # Keep the failed keys; events arriving meanwhile are merged into the retry
+            print(f"Watch: retrying in {backoff:.0f}s", file=sys.stderr)
+            time.sleep(backoff)
+            if keys is None:
+                next_resync = 0.0
+            else:
+                inbox.add(keys)
+                keys = inbox.take(0, 0, timeout=0) or keys
+
+def main(mode: str | None = None, keys: set[str] | None = None):
+    """One indexing run. mode overrides INGEST_MODE; keys limits it to the collections those object keys route to."""
+    with RunContext() as ctx:
+        run_once(ctx, mode, keys)
+
+def run_once(ctx: RunContext, mode: str | None = None, keys: set[str] | None = None):
+    """Body of main() on clients and pools that may be shared with earlier runs (watch)."""
+    embedder, minio_client, qdrant_client, bucket = ctx.embedder, ctx.minio_client, ctx.qdrant_client, ctx.bucket
+    provider, embedding_model, output_dim = embedder.name, embedder.model, embedder.dim
+
+    prefix = get_env("MINIO_PREFIX", "raw/").rstrip("/") + "/"
+    collection = get_env("QDRANT_COLLECTION", "rag_docs")
+    route_spec = get_env("INGEST_ROUTES")
+    if route_spec.lower() == "auto":
+        route_spec = "auto"
+
+    chunk_size = int(get_env("CHUNK_SIZE", "500"))
+    chunk_overlap = int(get_env("CHUNK_OVERLAP", "50"))
+    if not 0 <= chunk_overlap <= chunk_size // 2:
+        # Beyond half a chunk the window barely advances and nearly every chunk repeats its neighbour
+        print(f"CHUNK_OVERLAP {chunk_overlap} clamped to {max(0, min(chunk_overlap, chunk_size // 2))} (CHUNK_SIZE {chunk_size})",
+              file=sys.stderr)
+        chunk_overlap = max(0, min(chunk_overlap, chunk_size // 2))
+    chunk_unit = get_env("CHUNK_UNIT", "chars").lower()
+    if chunk_unit not in ("chars", "tokens"):
+        print(f"CHUNK_UNIT must be chars or tokens, got: {chunk_unit}", file=sys.stderr)
+        sys.exit(1)
+
+    mode = (mode or get_env("INGEST_MODE", "full")).lower()
+    if mode not in ("full", "incremental"):
+        print(f"INGEST_MODE must be full or incremental, got: {mode}", file=sys.stderr)
+        sys.exit(1)
+    manifest_key = get_env("MANIFEST_KEY", f"manifests/{collection}.json")
+    queue_size = int(get_env("PIPELINE_QUEUE_SIZE", "8"))
+    upsert_batch_size = int(get_env("UPSERT_BATCH_SIZE", "256"))
+    upsert_batch_bytes = int(get_env("UPSERT_BATCH_BYTES", str(4 << 20)))
+    upsert_concurrency = max(1, int(get_env("UPSERT_CONCURRENCY", "4")))
+    if get_env("QDRANT_LOCATION"):
+        upsert_concurrency = 1  # in-process Qdrant has no locking
+    upsert_wait = get_env("UPSERT_WAIT", "false").lower() == "true"
+    upsert_settle_seconds = float(get_env("UPSERT_SETTLE_SECONDS", "120"))
+    fetch_workers = ctx.fetch_workers
+    # Objects larger than this are streamed to a temp file instead of memory
+    spool_bytes = int(float(get_env("FETCH_SPOOL_MB", "16")) * (1 << 20))
+    spool_root = get_env("FETCH_SPOOL_DIR") or None
+    extract_workers = ctx.extract_workers
+    embed_batch_size = int(get_env("EMBED_BATCH_SIZE", str(embedder.batch_size)))
+    embed_batch_tokens = int(get_env("EMBED_BATCH_TOKENS", str(embedder.batch_tokens)))
+    embed_concurrency = max(1, int(get_env("EMBED_CONCURRENCY", "4")))
+    embed_retries = int(get_env("EMBED_MAX_RETRIES", "6"))
+    retention_hours = float(get_env("COLLECTION_RETENTION_HOURS", "48"))
+    checkpoint_interval = float(get_env("CHECKPOINT_INTERVAL", "30"))
+    checkpoint_max_age_hours = float(get_env("CHECKPOINT_MAX_AGE_HOURS", "24"))
+    dedup = get_env("DEDUP", "off").lower()
+    if dedup not in ("off", "minhash"):
+        print(f"DEDUP must be off or minhash, got: {dedup}", file=sys.stderr)
+        sys.exit(1)
+    report_target = get_env("RUN_REPORT", "minio").lower()
+    if report_target not in ("minio", "stdout", "off"):
+        print(f"RUN_REPORT must be minio, stdout or off, got: {report_target}", file=sys.stderr)
+        sys.exit(1)
+    started = time.time()
+    report_key = get_env("RUN_REPORT_KEY", "reports/{collection}/{started}.json").format(
+        collection=collection, started=time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(started)))
+    pushgateway = get_env("PUSHGATEWAY_URL")
+    pushgateway_job = get_env("PUSHGATEWAY_JOB", "rag_ingestion")
+    dedup_threshold = float(get_env("DEDUP_THRESHOLD", "0.9")) if dedup == "minhash" else 0.0
+    sparse_mode = get_env("SPARSE_VECTORS", "bm25").lower()
+    if sparse_mode not in ("bm25", "off"):
+        print(f"SPARSE_VECTORS must be bm25 or off, got: {sparse_mode}", file=sys.stderr)
+        sys.exit(1)
+    sparse_vectors = sparse_mode == "bm25"
+    quantization = get_env("QDRANT_QUANTIZATION", "none").lower()
+    if quantization not in QUANTIZATION:
+        print(f"QDRANT_QUANTIZATION must be none, scalar or binary, got: {quantization}", file=sys.stderr)
+        sys.exit(1)
+    # How the collection stores vectors/payload; changes apply in place without re-embedding
+    storage = {
+        "quantization": quantization,
+        "on_disk": get_env("QDRANT_ON_DISK", "false").lower() == "true",
+        "on_disk_payload": get_env("QDRANT_ON_DISK_PAYLOAD", "false").lower() == "true",
+        "hnsw_m": int(get_env("HNSW_M", "16")),
+        "hnsw_ef_construct": int(get_env("HNSW_EF_CONSTRUCT", "100")),
+    }
+
+    # One client for the whole run: every batch reuses its connection pool
+    embed_fn = embedder.embed_documents
+    print(f"Embedding: {embedder.describe()}")
+
+    if not minio_client.bucket_exists(bucket):
+        minio_client.make_bucket(bucket)
+        print(f"Created bucket {bucket}.")
+    text_cache = ctx.text_cache
+
+    # Any change here invalidates every stored vector, so incremental runs fall back to a full rebuild
+    config = {
+        "provider": provider,
+        "model": embedding_model,
+        "dim": output_dim,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "chunk_unit": chunk_unit,
+        "chunker": CHUNKER_VERSION,
+        "payload": PAYLOAD_VERSION,
+        "dedup": dedup_threshold,
+        "sparse": f"bm25-v{SPARSE_VERSION}" if sparse_vectors else "off",
+    }
+
+    if route_spec and route_spec != "auto":
+        route_map = parse_routes(route_spec)
+        # One listing covers every route: the longest common directory of the route prefixes
+        prefix = os.path.commonprefix(list(route_map))
+        prefix = prefix[: prefix.rfind("/") + 1]
+    if keys is not None:
+        # Event-driven run: only collections that a changed key routes to, each listed on its own
+        touched = [SimpleNamespace(object_name=k) for k in keys if k.startswith(prefix)]
+        if route_spec == "auto":
+            route_map = auto_routes(touched, prefix, collection)
+        elif not route_spec:
+            route_map = {prefix: collection}
+        hit = [route_of(o.object_name, [Route(p, c, "") for p, c in route_map.items()]) for o in touched]
+        route_map = {p: c for p, c in route_map.items() if any(r and r.prefix == p for r in hit)}
+        listed = list({
+            o.object_name: o
+            for p in route_map
+            for o in minio_client.list_objects(bucket, prefix=p, recursive=True)
+            if not o.object_name.endswith("/")
+        }.values())
+    else:
+        listed = [o for o in minio_client.list_objects(bucket, prefix=prefix, recursive=True) if not o.object_name.endswith("/")]
+        if route_spec == "auto":
+            route_map = auto_routes(listed, prefix, collection)
+            if not route_map:
+                print(f"No {prefix}<system_id>/ folders found in {bucket}. Upload PDF/txt then re-run.")
+        elif not route_spec:
+            route_map = {prefix: collection}
+    routes = [
+        Route(p, c, manifest_key if not route_spec else f"manifests/{c}.json",
+              f"checkpoints/{c}.json" if checkpoint_interval > 0 else "")
+        for p, c in route_map.items()
+    ]
+    if route_spec:
+        print("Routes: " + ", ".join(f"{r.prefix} -> {r.collection}" for r in routes))
+    by_route = defaultdict(list)
+    for o in listed:
+        r = route_of(o.object_name, routes)
+        if r:
+            by_route[r.collection].append(o)
+    unrouted = len(listed) - sum(len(v) for v in by_route.values())
+    if unrouted:
+        print(f"Ignoring {unrouted} objects under {bucket}/{prefix} that match no route.")
+
+    for route in routes:
+        prepare_route(qdrant_client, minio_client, bucket, route, by_route[route.collection], mode, config,
+                      storage, checkpoint_max_age_hours)
+
+    changed = [o for r in routes for o in r.changed]
+    owner = {o.object_name: r for r in routes for o in r.changed}
+    cache = ctx.embedding_cache() if changed else None
+    if cache:
+        cache.start_run()
+    # Pruning by used_at is only safe when this run looks up every live chunk: a fresh build of every route
+    prune_cache = keys is None and all(r.build and not r.resumed for r in routes)
+
+    def record(doc):
+        """Called once all points of doc are upserted."""
+        route = owner[doc.key]
+        if doc.missing:
+            delete_paths(qdrant_client, route.work, [doc.key])
+            route.entries.pop(doc.key, None)
+            route.current.pop(doc.key, None)
+            return
+        if doc.key in route.entries or route.resumed:
+            # Drop chunks of the old version (or of a half-written attempt) beyond the new ones
+            delete_stale_chunks(qdrant_client, route.work, doc.key, doc.indices)
+        route.entries[doc.key] = {"fingerprint": route.current[doc.key], "chunks": len(doc.indices)}
+        route.done.add(doc.key)
+        for kept in doc.merged_into:
+            route.duplicates.setdefault(kept, set()).add(doc.key)
+        if doc.indices:
+            print(f"  {doc.key}: {len(doc.indices)} chunks")
+        if route.checkpoint_key and time.monotonic() - route.checkpointed_at >= checkpoint_interval:
+            save_checkpoint(minio_client, bucket, route, config)
+
+    # Eviction/timeout sends SIGTERM: unwind through the checkpoint save below instead of dying silently
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    # One pipeline for all routes: fetch/extract/embed pools and the cache are shared, each doc
+    # carries the collection its points go to
+    targets = {key: r.work for key, r in owner.items()}
+    # Pools are shared across runs, the spool dir is not; a fetch still running after a failed run
+    # fails on the removed directory and its result is never read
+    with tempfile.TemporaryDirectory(prefix="ingest-spool-", dir=spool_root, ignore_cleanup_errors=True) as spool_dir:
+        docs = stage(fetch_docs(minio_client, bucket, changed, targets, ctx.fetch_pool, fetch_workers * 2, text_cache,
+                                spool_dir, spool_bytes), queue_size)
+        docs = stage(extract_docs(docs, ctx.extract_pool, max(extract_workers, 1) * 2, text_cache), queue_size)
+        docs = stage(chunk_docs(docs, chunk_size, chunk_overlap, chunk_unit), queue_size)
+        if dedup_threshold:
+            docs = stage(dedup_docs(docs, dedup_threshold), queue_size)
+        docs = stage(embed_docs(docs, embed_fn, embed_batch_size, embed_batch_tokens, embed_concurrency, embed_retries,
+                                cache=cache), queue_size)
+        try:
+            # Same uuid5(path:chunk_index) ids, so re-embedded chunks overwrite their old points in place
+            if not upsert_docs(qdrant_client, docs, upsert_batch_size, on_doc=record, batch_bytes=upsert_batch_bytes,
+                               concurrency=upsert_concurrency, wait_applied=upsert_wait, sparse=sparse_vectors):
+                print("No points to upsert.")
+        except BaseException as e:
+            prune_cache = False  # docs never reached were not looked up
+            # The retried Job (backoffLimit) resumes from here instead of starting over
+            for route in routes:
+                if route.checkpoint_key and route.done:
+                    save_checkpoint(minio_client, bucket, route, config)
+                    print(f"{route.collection}: checkpoint saved ({len(route.done)} objects done).", file=sys.stderr)
+            status = "interrupted" if isinstance(e, (SystemExit, KeyboardInterrupt)) else "failed"
+            publish_report(minio_client, bucket, run_report(collection, mode, routes, status, started, repr(e)),
+                           report_target, report_key, pushgateway, pushgateway_job)
+            raise
+        finally:
+            # Vectors already paid for stay useful even if this run fails part-way
+            if cache:
+                ctx.save_cache(prune_cache)
+
+    failed = [r.collection for r in routes
+              if not finish_route(qdrant_client, minio_client, bucket, r, config, storage, retention_hours,
+                                  upsert_settle_seconds, text_cache)]
+    print(f"Stages: {STATS.summary()} | peak RSS {peak_rss_mb():.0f} MB")
+    report = run_report(collection, mode, routes, "verify_failed" if failed else "ok", started,
+                        f"build failed for: {', '.join(failed)}" if failed else "")
+    publish_report(minio_client, bucket, report, report_target, report_key, pushgateway, pushgateway_job)
+    if failed:
+        print(f"Build failed for: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] in (["delete-path"], ["delete-prefix"]):
+        delete_command(sys.argv[1], sys.argv[2:])
+    elif sys.argv[1:2] == ["watch"]:
+        watch_command()
+    else:
+        main()
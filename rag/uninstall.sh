@@ -48,7 +48,8 @@ fi
 
 echo "[5/9] Delete RAG CronJob / Job"
 kubectl delete cronjob rag-ingestion-cronjob-cointutor rag-ingestion-cronjob-drillquiz -n "${NS}" --ignore-not-found=true 2>/dev/null || true
-kubectl delete cronjob rag-ingestion -n "${NS}" --ignore-not-found=true 2>/dev/null || true
+kubectl delete cronjob rag-ingestion rag-ingestion-cronjob-all -n "${NS}" --ignore-not-found=true 2>/dev/null || true
+kubectl delete deployment,service rag-ingestion-watch -n "${NS}" --ignore-not-found=true 2>/dev/null || true
 kubectl delete job rag-ingestion-job-cointutor rag-ingestion-job-drillquiz rag-ingestion-run qdrant-collection-init -n "${NS}" --ignore-not-found=true 2>/dev/null || true
 
 echo "[6/9] Delete RAG Backend / Frontend"